@@ -0,0 +1,317 @@
+import os
+import asyncio
+import logging
+from pathlib import Path
+
+import httpx
+
+from sapsam.conf import system_instance
+from sapsam.constants import BPMN2_NAMESPACE
+from sapsam.RepresentationGenerator import REPRESENTATION_EXTENSIONS
+from sapsam.SignavioAuthenticator import SignavioAuthenticator
+from sapsam.SignavioClient import get_retry_after
+
+_logger = logging.getLogger(__name__)
+
+class AsyncSignavioClient:
+    """
+    asyncio counterpart of SignavioClient based on httpx: one pooled connection pool, cached credentials with
+    transparent re-authentication on 401, retries after the Retry-After time on 429 and with exponential backoff
+    on server errors (5xx). At most max_concurrency
+    requests are in flight at once, a RateLimiter can be shared with other (also synchronous) clients so that all
+    of them stay within one rate budget. Use it as async context manager:
+        async with AsyncSignavioClient() as client:
+            summary = await client.export_representations(models, out_dir)
+    """
+
+    def __init__(self, instance=None, max_concurrency=8, rate_limiter=None, max_retries=3, backoff=1.0, timeout=60.0,
+                 transport=None):
+        """
+        Args:
+            instance (str): URL of the system instance. Default: system_instance of the conf file
+            max_concurrency (int): Maximum number of requests in flight (and of pooled connections). Default: 8
+            rate_limiter (RateLimiter): Limits all requests of the client, can be overridden per request.
+                                        Default: None (no limit)
+            max_retries (int): Number of retries of a request rejected with 429 or a server error. Default: 3
+            backoff (float): Seconds to wait before the first retry after a server error (or a 429 without
+                             Retry-After), doubled with every retry. Default: 1.0
+            timeout (float): Timeout of a request in seconds. Default: 60.0
+            transport (httpx.AsyncBaseTransport): Transport of the requests, e.g. httpx.MockTransport.
+                                                  Default: None (network)
+        """
+        self.instance = instance if instance is not None else system_instance
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._client = httpx.AsyncClient(
+            base_url=self.instance,
+            headers={'Accept': 'application/json'},
+            limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency),
+            timeout=timeout,
+            transport=transport)
+        self._auth_data = None
+        # created on first use, asyncio primitives have to be created inside the event loop before Python 3.10
+        self._auth_lock = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    def _get_semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._auth_lock = asyncio.Lock()
+        return self._semaphore
+
+    async def authenticate(self, expired=None):
+        """Logs in and stores the credentials in the client (cookies and x-signavio-id header).
+
+        Args:
+            expired (dict): Credentials that were rejected by the server. If another task has re-authenticated
+                            in the meantime, its credentials are used instead of logging in again.
+
+        Returns:
+            dictionary: Session information, see SignavioAuthenticator.authenticate
+        """
+        self._get_semaphore()
+        async with self._auth_lock:
+            if self._auth_data is None or self._auth_data is expired:
+                login_request = await self._client.post('/p/login', data=SignavioAuthenticator.get_login_data())
+                auth_data = {
+                    'jsesssion_ID': login_request.cookies['JSESSIONID'],
+                    'lb_route_ID': login_request.cookies['LBROUTEID'],
+                    'auth_token': login_request.content.decode('utf-8')
+                }
+                self._client.headers['x-signavio-id'] = auth_data['auth_token']
+                self._auth_data = auth_data
+            return self._auth_data
+
+    async def request(self, method, path, rate_limiter=None, **kwargs):
+        """Sends a request with the session credentials, see SignavioClient.request, server errors are retried as
+        well (up to max_retries with backoff). The request waits for a free slot of the max_concurrency slots
+        before it takes a token of the rate limiter.
+
+        Args:
+            method (str): HTTP method
+            path (str): Path relative to the system instance (e.g. '/p/model')
+            rate_limiter (RateLimiter): Limiter for this request. Default: None (rate_limiter of the client)
+            kwargs: Passed to httpx.AsyncClient.request
+
+        Returns:
+            httpx.Response
+        """
+        if rate_limiter is None:
+            rate_limiter = self.rate_limiter
+        async with self._get_semaphore():
+            auth_data = self._auth_data if self._auth_data is not None else await self.authenticate()
+            reauthenticated = False
+            retries = 0
+            while True:
+                if rate_limiter is not None:
+                    await rate_limiter.acquire_async()
+                response = await self._client.request(method, path, **kwargs)
+                if response.status_code == 401 and not reauthenticated:
+                    _logger.info("Session expired, re-authenticating")
+                    auth_data = await self.authenticate(expired=auth_data)
+                    reauthenticated = True
+                    continue
+                if (response.status_code != 429 and response.status_code < 500) or retries >= self.max_retries:
+                    return response
+                if response.status_code == 429:
+                    retry_after = get_retry_after(response, default=self.backoff * 2 ** retries)
+                    _logger.info("Rate limit exceeded, retrying in %.1f s", retry_after)
+                else:
+                    retry_after = self.backoff * 2 ** retries
+                    _logger.info("Server error %d, retrying in %.1f s", response.status_code, retry_after)
+                retries += 1
+                if rate_limiter is not None and response.status_code == 429:
+                    # the whole budget waits, not only this request
+                    rate_limiter.pause(retry_after)
+                else:
+                    await asyncio.sleep(retry_after)
+
+    async def _request_json(self, method, path, **kwargs):
+        response = await self.request(method, path, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    async def list_directories(self):
+        """
+        Returns the root directories of the workspace (GET /p/directory).
+        """
+        return await self._request_json('GET', '/p/directory')
+
+    async def get_directory(self, dir_id):
+        """
+        Returns the content of a directory (GET /p/directory/<dir_id>).
+        """
+        return await self._request_json('GET', f'/p/directory/{dir_id}')
+
+    async def create_folder(self, name, parent_id):
+        """
+        Creates a folder in the directory parent_id and returns its ID.
+        """
+        result = await self._request_json('POST', '/p/directory',
+                                          data={'name': name, 'parent': f'/directory/{parent_id}'})
+        return result['href'].replace('/directory/', '')
+
+    async def get_sapsam_folder_id(self):
+        """
+        Returns the ID of the SAP-SAM folder in 'My documents' (or the first root directory), the folder is created
+        if it does not exist, see RepresentationGenerator._setup_folder.
+        """
+        directories = await self.list_directories()
+        dir_id = next((d['href'].replace('/directory/', '') for d in directories
+                       if d.get('rel') == 'dir' and d['rep']['name'] == 'My documents'),
+                      directories[0]['href'].replace('/directory/', ''))
+        for result in await self.get_directory(dir_id):
+            if result.get('rep', {}).get('name') == 'SAP-SAM' and 'directory' in result['href']:
+                return result['href'].replace('/directory/', '')
+        return await self.create_folder('SAP-SAM', dir_id)
+
+    async def create_model(self, name, json_data, namespace, folder_id):
+        """
+        Creates a diagram in the folder folder_id and returns its ID and revision ID.
+        """
+        result = await self._request_json('POST', '/p/model', data={
+            'parent': f'/directory/{folder_id}',
+            'name': name,
+            'namespace': namespace,
+            'json_xml': json_data
+        })
+        return result['href'].replace('/model/', ''), result['rep']['revision'].replace('/revision/', '')
+
+    async def delete_model(self, model_id):
+        response = await self.request('DELETE', f'/p/model/{model_id}')
+        return response.status_code == 200
+
+    async def get_representation(self, model_id, revision_id, rep):
+        """
+        Returns a representation of a diagram revision ('png', 'svg', 'bpmn2_0_xml', 'json' or 'dmn') as bytes.
+        """
+        path = f'/p/model/{model_id}/rdf' if rep == 'dmn' else f'/p/revision/{revision_id}/{rep}'
+        response = await self.request('GET', path)
+        response.raise_for_status()
+        return response.content
+
+    async def syntax_check(self, model_json, rate_limiter=None):
+        """
+        Returns the syntax errors and warnings of a BPMN model, see SignavioConventionsChecker.syntax_checker.
+        """
+        rep_data = (await self._request_json('POST', '/p/syntaxchecker', rate_limiter=rate_limiter, data={
+            'isJson': 'true',
+            'data_json': model_json,
+            'ns': BPMN2_NAMESPACE
+        })).get('rep', [])
+        return {'errors': rep_data[0].get('must', []), 'warnings': rep_data[0].get('should', [])}
+
+    async def guideline_check(self, name, model_id, guideline_id, model_json, rate_limiter=None):
+        """
+        Returns the numbers of BP convention violations, see SignavioConventionsChecker.bp_conventions_checker.
+        """
+        rep_data = (await self._request_json('POST', '/p/mgeditorchecker', rate_limiter=rate_limiter, data={
+            'comments': '{}',
+            'guidelineId': guideline_id,
+            'name': name,
+            'model_json': model_json,
+            'id': model_id,
+            'checkLinking': 'false'
+        })).get('rep', [])
+        return {
+            'errors': len(rep_data[0].get('must', [])),
+            'warnings': len(rep_data[0].get('should', [])),
+            'info': len(rep_data[0].get('info', []))
+        }
+
+    async def _export_model(self, model, out_dir, reps, folder_id, deletes):
+        model_id, name, json_data, namespace = model
+        paths = {rep: out_dir / rep / f'{model_id}.{REPRESENTATION_EXTENSIONS[rep]}' for rep in reps}
+        paths = {rep: path for rep, path in paths.items() if not path.exists()}
+        if not paths:
+            return 'skipped'
+        diagram_id, revision_id = await self.create_model(name, json_data, namespace, folder_id)
+        try:
+            contents = await asyncio.gather(*(self.get_representation(diagram_id, revision_id, rep) for rep in paths))
+        finally:
+            if deletes:
+                await self.delete_model(diagram_id)
+        for path, content in zip(paths.values(), contents):
+            tmp_path = path.with_name(path.name + '.part')
+            tmp_path.write_bytes(content)
+            os.replace(tmp_path, path)
+        return 'exported'
+
+    async def export_representations(self, models, out_dir, reps=('png',), deletes=True, max_pending=None):
+        """Exports the representations of the models like RepresentationGenerator.export_representations (same
+        file layout, resumed by skipping models whose files exist), with up to max_pending models in progress at
+        once. Models are taken from the iterable only when a slot is free, so a large (lazy) iterable is never
+        materialized.
+
+        Args:
+            models (iterable): (model ID, name, JSON representation, namespace) tuples
+            out_dir (Path): Output directory
+            reps (tuple): Representations to export, see REPRESENTATION_EXTENSIONS. Default: ('png',)
+            deletes (bool): If True, deletes each uploaded diagram after its representations are fetched.
+                            Default: True
+            max_pending (int): Number of models in progress at once. Default: None (2 * max_concurrency)
+
+        Returns:
+            dictionary: Number of exported and skipped models, and the IDs of the models that failed
+        """
+        out_dir = Path(out_dir)
+        for rep in reps:
+            if rep not in REPRESENTATION_EXTENSIONS:
+                raise ValueError(f"Unknown representation: {rep}, available: {list(REPRESENTATION_EXTENSIONS)}")
+            (out_dir / rep).mkdir(parents=True, exist_ok=True)
+        folder_id = await self.get_sapsam_folder_id()
+        summary = {'exported': 0, 'skipped': 0, 'failed': []}
+
+        async def export(model):
+            try:
+                summary[await self._export_model(model, out_dir, reps, folder_id, deletes)] += 1
+            except (httpx.HTTPError, KeyError, ValueError):
+                _logger.exception("Failed to export model %s", model[0])
+                summary['failed'].append(model[0])
+
+        await bounded_gather((export(model) for model in models),
+                             max_pending if max_pending is not None else 2 * self.max_concurrency)
+        _logger.info("Exported %d models, skipped %d, failed %d", summary['exported'], summary['skipped'],
+                     len(summary['failed']))
+        return summary
+
+async def bounded_gather(coros, max_pending):
+    """
+    Runs the coroutines of the (lazy) iterable coros with at most max_pending of them at once and returns their
+    results in order. The next coroutine is only taken from coros when one finishes, which gives backpressure to
+    the producer of coros. If a coroutine fails, the pending ones are cancelled and the exception is raised.
+    """
+    results = []
+
+    async def run(i, coro):
+        results[i] = await coro
+
+    pending = set()
+    try:
+        for coro in coros:
+            if len(pending) >= max_pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+            results.append(None)
+            pending.add(asyncio.ensure_future(run(len(results) - 1, coro)))
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+    except BaseException:
+        for task in pending:
+            task.cancel()
+        raise
+    return results
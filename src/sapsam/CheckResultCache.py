@@ -0,0 +1,152 @@
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+
+from sapsam.constants import DATA_INTERIM
+
+_logger = logging.getLogger(__name__)
+
+class CheckResultCache:
+    """
+    Persistent SQLite cache of API check results (e.g. syntax and BP conventions checks), keyed by the name of the
+    check and a SHA-256 hash of everything the result depends on (model JSON, guideline ID, namespace, ...).
+    Results older than ttl seconds are treated as missing. In offline mode, misses are not computed, so only
+    cached results are served. The cache can be shared by threads.
+    """
+
+    def __init__(self, path=None, ttl=None, offline=False):
+        """
+        Args:
+            path (Path): SQLite database file. Default: None (DATA_INTERIM / 'check_results.sqlite')
+            ttl (float): Seconds after which a result expires. Default: None (results never expire)
+            offline (bool): If True, misses are not computed and return None. Default: False
+        """
+        self.path = Path(path) if path is not None else DATA_INTERIM / 'check_results.sqlite'
+        self.ttl = ttl
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS results (check_name TEXT, key TEXT, result TEXT, created REAL, '
+            'accessed REAL, PRIMARY KEY (check_name, key))')
+
+    @staticmethod
+    def get_key(key_parts):
+        """Hashes the values a result depends on
+
+        Args:
+            key_parts (list): Strings (or bytes) the result depends on, None is hashed like an empty string
+
+        Returns:
+            str: Hex digest
+        """
+        digest = hashlib.sha256()
+        for part in key_parts:
+            if part is None:
+                part = ''
+            digest.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+            # separator, so that e.g. ('ab', 'c') and ('a', 'bc') get different keys
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def get(self, check_name, key):
+        """Returns the cached result or None if it is missing or expired, and updates the hit/miss statistics
+
+        Returns:
+            str: Cached result
+        """
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute('SELECT result, created FROM results WHERE check_name = ? AND key = ?',
+                                           (check_name, key)).fetchone()
+            if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._connection.execute('UPDATE results SET accessed = ? WHERE check_name = ? AND key = ?',
+                                     (now, check_name, key))
+            return row[0]
+
+    def put(self, check_name, key, result):
+        now = time.time()
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                                     (check_name, key, result, now, now))
+
+    def get_or_compute(self, check_name, key_parts, compute):
+        """Returns the cached result of the check, or computes and caches it. Results that are None (failed
+        checks) are not cached. In offline mode, None is returned for misses without computing them.
+
+        Args:
+            check_name (str): Name of the check
+            key_parts (list): Values the result depends on, see get_key
+            compute (callable): Computes the result if it is not cached
+
+        Returns:
+            str: Result
+        """
+        key = self.get_key(key_parts)
+        result = self.get(check_name, key)
+        if result is not None or self.offline:
+            return result
+        result = compute()
+        if result is not None:
+            self.put(check_name, key, result)
+        return result
+
+    def stats(self):
+        """
+        Returns the hits, misses, hit rate, and number of cached results.
+        """
+        with self._lock:
+            size = self._connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0.0,
+            'size': size
+        }
+
+    def evict(self, max_entries=None):
+        """Deletes the expired results and, with max_entries, the least recently used results beyond max_entries
+
+        Returns:
+            int: Number of deleted results
+        """
+        with self._lock:
+            deleted = 0
+            if self.ttl is not None:
+                deleted += self._connection.execute('DELETE FROM results WHERE created < ?',
+                                                    (time.time() - self.ttl,)).rowcount
+            if max_entries is not None:
+                deleted += self._connection.execute(
+                    'DELETE FROM results WHERE rowid NOT IN '
+                    '(SELECT rowid FROM results ORDER BY accessed DESC LIMIT ?)', (max_entries,)).rowcount
+        _logger.info("Evicted %d check results", deleted)
+        return deleted
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute('DELETE FROM results')
+
+    def close(self):
+        self._connection.close()
+
+_default_cache = None
+
+def get_check_cache():
+    """
+    Returns the cache that is used by the convention checkers if they are not given a cache.
+    """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = CheckResultCache()
+    return _default_cache
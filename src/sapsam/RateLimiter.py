@@ -0,0 +1,68 @@
+import time
+import asyncio
+import threading
+
+class RateLimiter:
+    """
+    Thread-safe token bucket that limits requests to rate per per seconds. Unlike a fixed sleep after each request,
+    the time a request takes counts towards the interval and requests of several threads can overlap, so the
+    quota is used completely. pause() blocks all requests, e.g. for the Retry-After time of a 429 response.
+    """
+
+    def __init__(self, rate, per=60.0, burst=1):
+        """
+        Args:
+            rate (int): Number of requests per period
+            per (float): Period in seconds. Default: 60.0
+            burst (int): Number of requests that may be sent at once after an idle time. Default: 1
+        """
+        self.interval = per / rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Takes a token and returns the seconds to wait before the request may be sent. Tokens are handed out
+        first come, first served, the bucket goes negative for reserved tokens.
+
+        Returns:
+            float: Seconds to wait
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) / self.interval)
+            self._updated = now
+            self._tokens -= 1
+            return max(-self._tokens * self.interval, self._blocked_until - now, 0.0)
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent.
+        """
+        wait = self.reserve()
+        while wait > 0:
+            time.sleep(wait)
+            # a pause may have started while waiting
+            wait = self._blocked_until - time.monotonic()
+
+    async def acquire_async(self):
+        """
+        Waits without blocking the event loop until a request may be sent, the budget is shared with the threads
+        that call acquire.
+        """
+        wait = self.reserve()
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self._blocked_until - time.monotonic()
+
+    def pause(self, seconds):
+        """Blocks all requests for seconds and drops the accumulated burst
+
+        Args:
+            seconds (float): Seconds to block
+        """
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._tokens = min(self._tokens, 0)
@@ -1,23 +1,65 @@
-import json, requests
-from sapsam.conf import system_instance
-from sapsam.SignavioAuthenticator import SignavioAuthenticator
+import os
+import json
+import logging
+from pathlib import Path
+import requests
+from tqdm import tqdm
+from sapsam.SignavioClient import resolve_client
+
+_logger = logging.getLogger(__name__)
+
+# file extensions of the representations written by export_representations
+REPRESENTATION_EXTENSIONS = {
+    'png': 'png',
+    'svg': 'svg',
+    'bpmn2_0_xml': 'bpmn',
+    'dmn': 'dmn',
+    'json': 'json'
+}
 
 class RepresentationGenerator:
     """
     Class that generates images based on JSON or XML representations
     """
 
+    def __init__(self, client=None):
+        """
+        Args:
+            client (SignavioClient): Client that sends the API requests, or the credentials of
+                                     SignavioAuthenticator.authenticate (see SignavioClient.resolve_client).
+                                     Default: None (client shared within the process, see SignavioClient.get_client)
+        """
+        self.client = resolve_client(client)
+        self._folder_id = None
+
+    def _get_folder_id(self):
+        """Returns the ID of the SAP-SAM folder, it is only looked up (or created) once per generator
+
+        Returns:
+            str: Folder ID
+        """
+        if self._folder_id is None:
+            self._folder_id = self._setup_folder()
+        return self._folder_id
+
     def _delete_diagram(self, id: str):
         """Deletes a diagram in a SAP Signavio Process Manager workspace (by ID)
 
         Args:
             id (str): diagram/model ID
+
+        Returns:
+            bool: True if the diagram was deleted (or did not exist anymore)
         """
-        auth_data = SignavioAuthenticator.authenticate()
-        model_url = system_instance + '/p/model'
-        cookies = {'JSESSIONID': auth_data['jsesssion_ID'], 'LBROUTEID': auth_data['lb_route_ID']}
-        headers = {'Accept': 'application/json', 'x-signavio-id':  auth_data['auth_token']}
-        requests.delete(f'{model_url}/{id}', cookies=cookies, headers=headers)
+        try:
+            response = self.client.delete(f'/p/model/{id}')
+        except requests.RequestException:
+            _logger.warning("Failed to delete diagram %s", id, exc_info=True)
+            return False
+        if response.status_code != 404 and not 200 <= response.status_code < 300:
+            _logger.warning("Failed to delete diagram %s: status %d", id, response.status_code)
+            return False
+        return True
     
     def _get_dir_id(self, meta_request):
         """Retrieves the directory ID where the SAP-SAM folder will be stored. If possible,
@@ -43,19 +85,10 @@ class RepresentationGenerator:
         Returns:
             str: Folder ID
         """
-        auth_data = SignavioAuthenticator.authenticate()
-        dir_url = system_instance + '/p/directory'
-        cookies = {'JSESSIONID': auth_data['jsesssion_ID'], 'LBROUTEID': auth_data['lb_route_ID']}
-        headers = {'Accept': 'application/json', 'x-signavio-id':  auth_data['auth_token']}
-        get_dir_meta_request = requests.get(
-            dir_url,
-            cookies=cookies,
-            headers=headers)
+        dir_url = '/p/directory'
+        get_dir_meta_request = self.client.get(dir_url)
         dir_id = self._get_dir_id(get_dir_meta_request)
-        get_shared_docs_meta_request = requests.get(
-            f'{dir_url}/{dir_id}',
-            cookies=cookies,
-            headers=headers)
+        get_shared_docs_meta_request = self.client.get(f'{dir_url}/{dir_id}')
         results = get_shared_docs_meta_request.json()
         folder_names_hrefs = [(result['rep']['name'], result['href']) for result in results if 'rep' in result and 'name' in result['rep']]
         sapsam_id = None
@@ -65,10 +98,8 @@ class RepresentationGenerator:
         if not sapsam_id == None:
             return sapsam_id
         else:
-            create_dir_request = requests.post(
+            create_dir_request = self.client.post(
             f'{dir_url}',
-            cookies=cookies,
-            headers=headers,
             data={'name': 'SAP-SAM', 'parent': f'/directory/{dir_id}'})
             return json.loads(create_dir_request.content)['href'].replace('/directory/', '')
 
@@ -87,38 +118,124 @@ class RepresentationGenerator:
         Returns:
             Representation of the diagram in the desired format
         """
-        auth_data = SignavioAuthenticator.authenticate()
-        model_url = system_instance + '/p/model'
-        cookies = {'JSESSIONID': auth_data['jsesssion_ID'], 'LBROUTEID': auth_data['lb_route_ID']}
-        headers = {'Accept': 'application/json', 'x-signavio-id':  auth_data['auth_token']}
+        model_id, revision_id = self._upload_diagram(name, json_data, namespace)
+        rep_request = self._get_representation(model_id, revision_id, rep)
+        if deletes:
+            self._delete_diagram(model_id)
+        return rep_request.content
+
+    def _upload_diagram(self, name, json_data, namespace):
+        """Creates a diagram in the SAP-SAM folder
+
+        Returns:
+            tuple: ID and revision ID of the created diagram
+        """
         data = {
-            'parent': '/directory/' + self._setup_folder(),
+            'parent': '/directory/' + self._get_folder_id(),
             'name': name,
             'namespace': namespace,
             'json_xml': json_data
         }
-        create_diagram_request = requests.post(
-            model_url,
-            cookies=cookies,
-            headers=headers,
+        create_diagram_request = self.client.post(
+            '/p/model',
             data=data)
         result = json.loads(create_diagram_request.content)
         model_id = result['href'].replace('/model/', '')
         revision_id = result['rep']['revision'].replace('/revision/', '')
-        diagram_url = system_instance + '/p/revision'
+        return model_id, revision_id
+
+    def _get_representation(self, model_id, revision_id, rep):
         if rep == 'dmn':
-            rep_request = requests.get(
-                f'{model_url}/{model_id}/rdf',
-                cookies=cookies,
-                headers=headers)
+            return self.client.get(f'/p/model/{model_id}/rdf')
+        return self.client.get(f'/p/revision/{revision_id}/{rep}')
+
+    def _delete_diagrams(self, ids, pending_path):
+        # the diagrams that could not be deleted stay in ids and in the pending file, so they are deleted later
+        ids[:] = [id for id in ids if not self._delete_diagram(id)]
+        if ids:
+            pending_path.write_text(json.dumps(ids))
         else:
-            rep_request = requests.get(
-                f'{diagram_url}/{revision_id}/{rep}',
-                cookies=cookies,
-                headers=headers)
-        if deletes:
-            self._delete_diagram(model_id)
-        return rep_request.content
+            pending_path.unlink(missing_ok=True)
+
+    def export_representations(self, models, out_dir, reps=('png',), deletes=True, delete_batch_size=100):
+        """Uploads the diagrams one by one to the SAP-SAM folder in Signavio Process Manager and writes all
+        requested representations of each diagram to out_dir/<rep>/<model ID>.<extension>. Each diagram is
+        uploaded once for all representations, the folder is only looked up once. Models whose representations
+        all exist already are skipped, so an interrupted export is resumed by calling it again. Files are written
+        atomically, so a present file is always complete.
+
+        Args:
+            models (iterable): (model ID, name, JSON representation, namespace) tuples, e.g.
+                               parser.parse_model()[['name', 'model_json', 'namespace']].itertuples()
+            out_dir (Path): Output directory
+            reps (tuple): Representations to export, see REPRESENTATION_EXTENSIONS. Default: ('png',)
+            deletes (bool): If True, deletes the uploaded diagrams, in batches of delete_batch_size
+                            (the IDs of not yet deleted diagrams are kept in out_dir/pending_deletions.json
+                            and deleted on the next call if the export is interrupted or a delete fails).
+                            Default: True
+            delete_batch_size (int): Number of uploaded diagrams after which they are deleted. Default: 100
+
+        Returns:
+            dictionary: Number of exported and skipped models, and the IDs of the models that failed
+        """
+        out_dir = Path(out_dir)
+        for rep in reps:
+            if rep not in REPRESENTATION_EXTENSIONS:
+                raise ValueError(f"Unknown representation: {rep}, available: {list(REPRESENTATION_EXTENSIONS)}")
+            (out_dir / rep).mkdir(parents=True, exist_ok=True)
+        pending_path = out_dir / 'pending_deletions.json'
+        pending_ids = json.loads(pending_path.read_text()) if pending_path.exists() else []
+        if pending_ids:
+            _logger.info("Deleting %d diagrams left over from an interrupted export", len(pending_ids))
+            self._delete_diagrams(pending_ids, pending_path)
+
+        # diagrams whose delete failed are retried with the next batch, not after every upload
+        n_undeleted = len(pending_ids)
+        summary = {'exported': 0, 'skipped': 0, 'failed': []}
+        try:
+            for model_id, name, json_data, namespace in tqdm(models):
+                paths = {rep: out_dir / rep / f'{model_id}.{REPRESENTATION_EXTENSIONS[rep]}' for rep in reps}
+                if all(path.exists() for path in paths.values()):
+                    summary['skipped'] += 1
+                    continue
+                try:
+                    diagram_id, revision_id = self._upload_diagram(name, json_data, namespace)
+                except (ValueError, KeyError):
+                    _logger.warning("Failed to upload model %s", model_id)
+                    summary['failed'].append(model_id)
+                    continue
+                if deletes:
+                    pending_ids.append(diagram_id)
+                    pending_path.write_text(json.dumps(pending_ids))
+                failed = False
+                for rep, path in paths.items():
+                    if path.exists():
+                        continue
+                    rep_request = self._get_representation(diagram_id, revision_id, rep)
+                    if rep_request.status_code != 200:
+                        _logger.warning("Failed to get %s of model %s: status %d", rep, model_id,
+                                        rep_request.status_code)
+                        failed = True
+                        continue
+                    tmp_path = path.with_name(path.name + '.part')
+                    tmp_path.write_bytes(rep_request.content)
+                    os.replace(tmp_path, path)
+                if failed:
+                    summary['failed'].append(model_id)
+                else:
+                    summary['exported'] += 1
+                if len(pending_ids) - n_undeleted >= delete_batch_size:
+                    self._delete_diagrams(pending_ids, pending_path)
+                    n_undeleted = len(pending_ids)
+        finally:
+            if pending_ids:
+                self._delete_diagrams(pending_ids, pending_path)
+                if pending_ids:
+                    _logger.warning("%d diagrams could not be deleted, their IDs are kept in %s", len(pending_ids),
+                                    pending_path)
+        _logger.info("Exported %d models, skipped %d, failed %d", summary['exported'], summary['skipped'],
+                     len(summary['failed']))
+        return summary
 
     def generate_image(self, name, data, namespace, deletes=True):
         """Uploads a diagram to the SAP-SAM folder in Signavio Process Manager
@@ -1,6 +1,8 @@
 import os
+import csv
 import glob
 import logging
+import posixpath
 import re
 import json
 import time
@@ -9,15 +11,20 @@ import shutil
 
 import pandas as pd
 
-from typing import List
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Iterator, List, Tuple
 from zipfile import ZipFile
 from pathlib import Path
 from tqdm import tqdm
 
 from sapsam.constants import *
+from sapsam.decoders import get_json_loads
 
 _logger = logging.getLogger(__name__)
 
+SGX_CSV_COLUMNS = ['Revision ID', 'Model ID', 'Organisation ID', 'Datetime', 'Model JSON', 'Description', 'Name', 'Type', 'Namespace']
+
 def extract_zip_file(path):
     with ZipFile(path, 'r') as zObject:
 
@@ -51,47 +58,64 @@ def return_directory_paths(file_path):
     else:
         return False
 
+def walk_json_paths(path) -> Iterator[Tuple[str, List[str], List[str]]]:
+    """
+    Walks the directory tree below path in a single pass with os.scandir and yields, per directory,
+    the directory path and the paths of its JSON model files (*_.json) and JSON metadata files (model_meta.json).
+    """
+    stack = [str(path)]
+    while stack:
+        directory = stack.pop()
+        json_value_paths = []
+        json_metadata_paths = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    stack.append(entry.path)
+                elif entry.name == "model_meta.json":
+                    json_metadata_paths.append(entry.path)
+                elif re.search("_.json$", entry.name) is not None:
+                    json_value_paths.append(entry.path)
+        yield directory, json_value_paths, json_metadata_paths
+
+def fetch_model_json_paths(path) -> List[Tuple[str, str]]:
+    """
+    Returns the (JSON model file, JSON metadata file) path pair of every model folder below path.
+    """
+    pairs = []
+    for directory, json_value_paths, json_metadata_paths in walk_json_paths(path):
+        if len(json_value_paths) == 1 and len(json_metadata_paths) == 1:
+            pairs.append((json_value_paths[0], json_metadata_paths[0]))
+        elif json_value_paths or json_metadata_paths:
+            _logger.warning("Skipping %s, expected one model and one metadata file", directory)
+    return pairs
+
 def recursivly_fetch_json_paths(path):
-    paths=get_directory_paths(path)
-    
-    # fetch all path which lead to a JSON value file
-    json_value_paths = list(map(return_json_value_paths, paths))
-    while False in json_value_paths:
-        json_value_paths.remove(False)
-        
-    # fetch all paths which lead to JSON metadata file
-    json_metadata_paths = list(map(return_json_metadata_paths, paths))
-    while False in json_metadata_paths:
-        json_metadata_paths.remove(False)
-        
-    # fetch all paths which lead to a directory
-    directory_paths = list(map(return_directory_paths, paths))
-    while False in directory_paths:
-        directory_paths.remove(False)
-        
-    if len(directory_paths) > 0:
-        for directory_path in directory_paths:
-            json_value_paths.extend(recursivly_fetch_json_paths(directory_path)[0])
-            json_metadata_paths.extend(recursivly_fetch_json_paths(directory_path)[1])
+    json_value_paths = []
+    json_metadata_paths = []
+    for _, directory_value_paths, directory_metadata_paths in walk_json_paths(path):
+        json_value_paths.extend(directory_value_paths)
+        json_metadata_paths.extend(directory_metadata_paths)
     return json_value_paths, json_metadata_paths
 
-def convert_sgx_export(path):
+def convert_sgx_export(path, json_backend="auto"):
     print("Extracting zip file from path "+str(path)+" ...")
     extract_zip_file(path)
     print("Zip extracted to path "+str(path[:path.rfind("/")]+"/ExtractedSGXExport"))
     
     print("Starting to get file paths...")
-    all_json_value_paths, all_json_metadata_paths = recursivly_fetch_json_paths(str(path[:path.rfind("/")]+"/ExtractedSGXExport"))
+    json_paths = fetch_model_json_paths(path[:path.rfind("/")]+"/ExtractedSGXExport")
+    all_json_value_paths = [json_value_path for json_value_path, _ in json_paths]
+    all_json_metadata_paths = [json_metadata_path for _, json_metadata_path in json_paths]
     print("Found "+str(len(all_json_value_paths))+" json model files and "+str(len(all_json_metadata_paths))+" json metadata files. Loading data...")
     
+    loads = get_json_loads(json_backend)
     model_json_df=pd.DataFrame(columns = ['Revision ID', 'Model ID', 'Organisation ID', 'Datetime', 'Model JSON', 'Description', 'Name', 'Type', 'Namespace'])													
     for iloc in tqdm(range(0, len(all_json_value_paths))):
-        json_value_file = open(all_json_value_paths[iloc])
-        json_metadata_file = open(all_json_metadata_paths[iloc])
-
-        # returns JSON object as a dictionary
-        data = json.load(json_value_file)
-        metadata = json.load(json_metadata_file)
+        with open(all_json_value_paths[iloc], 'rb') as json_value_file:
+            data = loads(json_value_file.read())
+        with open(all_json_metadata_paths[iloc], 'rb') as json_metadata_file:
+            metadata = loads(json_metadata_file.read())
 
         if 'type' in metadata:
             modelType=metadata['type']
@@ -106,10 +130,116 @@ def convert_sgx_export(path):
                                                                 'Namespace': metadata['namespace']})], axis=0)
     return model_json_df.reset_index(drop=True)
 
-def convert_sgx_to_csv():
-    sgx_files = [filename for filename in os.listdir(DATA_DATASET) if filename.endswith('.sgx')]
+def iter_sgx_models(path, json_backend="auto") -> Iterator[Dict[str, str]]:
+    """
+    Reads the models of an SGX export directly from the zip archive, without extracting it. Every model folder
+    contains a model file (*_.json) and a metadata file (model_meta.json), which are paired by their folder.
+    Like fetch_model_json_paths, folders without exactly one model and one metadata file are skipped.
+    The model JSON is passed on as is, only the metadata is decoded.
+
+    Yields:
+        dict: One csv row (see SGX_CSV_COLUMNS) per model
+    """
+    loads = get_json_loads(json_backend)
+    with ZipFile(path, 'r') as zip_file:
+        json_value_infos = defaultdict(list)
+        json_metadata_infos = defaultdict(list)
+        for info in zip_file.infolist():
+            directory, file_name = posixpath.split(info.filename)
+            if file_name == "model_meta.json":
+                json_metadata_infos[directory].append(info)
+            elif re.search("_.json$", file_name) is not None:
+                json_value_infos[directory].append(info)
+
+        # in archive order, folders without metadata file last
+        directories = list(json_metadata_infos) + [d for d in json_value_infos if d not in json_metadata_infos]
+        for directory in directories:
+            if len(json_value_infos[directory]) != 1 or len(json_metadata_infos[directory]) != 1:
+                _logger.warning("Skipping %s, expected one model and one metadata file", directory)
+                continue
+            metadata = loads(zip_file.read(json_metadata_infos[directory][0]))
+            model_id = posixpath.basename(directory)
+            if model_id.startswith("model_"):
+                model_id = model_id[len("model_"):]
+            yield {'Model ID': model_id,
+                   'Datetime': metadata['creationDate'],
+                   'Model JSON': zip_file.read(json_value_infos[directory][0]).decode('utf-8'),
+                   'Name': metadata['name'],
+                   'Type': metadata.get('type', ""),
+                   'Namespace': metadata['namespace']}
+
+def convert_sgx_export_to_csv(path, csv_path, json_backend="auto") -> int:
+    """
+    Converts an SGX export to a csv in the dataset format. Models are streamed from the archive and written row by
+    row, so memory usage does not grow with the size of the export and no files are extracted.
+
+    Returns:
+        int: Number of converted models
+    """
+    n_models = 0
+    with open(csv_path, 'w', newline='', encoding='utf-8') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=SGX_CSV_COLUMNS, lineterminator='\n')
+        writer.writeheader()
+        for row in tqdm(iter_sgx_models(path, json_backend)):
+            writer.writerow(row)
+            n_models += 1
+    return n_models
+
+def _convert_sgx_archive(sgx_path: Path, csv_path: Path) -> int:
+    # every archive writes to its own partial file that is only renamed once the conversion succeeded,
+    # so neither a concurrent nor an interrupted conversion leaves an incomplete csv behind
+    part_path = csv_path.with_name(csv_path.name + ".part")
+    try:
+        n_models = convert_sgx_export_to_csv(sgx_path, part_path)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    os.replace(part_path, csv_path)
+    return n_models
+
+def _iter_sgx_conversions(jobs, n_workers=1):
+    if n_workers == 1:
+        for sgx_file, sgx_path, csv_path in jobs:
+            try:
+                yield sgx_file, _convert_sgx_archive(sgx_path, csv_path), None
+            except Exception as e:
+                yield sgx_file, None, e
+        return
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(_convert_sgx_archive, sgx_path, csv_path): sgx_file
+                   for sgx_file, sgx_path, csv_path in jobs}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e
+
+def _load_conversion_manifest(manifest_path: Path) -> Dict[str, Dict]:
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+def _save_conversion_manifest(manifest: Dict[str, Dict], manifest_path: Path):
+    tmp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+def convert_sgx_to_csv(n_workers=1):
+    """
+    Converts all SGX archives in DATA_DATASET to csvs and moves the archives to DATA_DATASET/zip_exports.
+    With n_workers != 1 the archives are converted in a process pool (n_workers=None uses all cores).
+    Every archive gets its csv number (in alphabetical order of the archive names, after the already numbered
+    csvs) before the conversion starts. The numbers are recorded in zip_exports/conversions.json together
+    with the conversion status, so a failed or interrupted run can be repeated and only converts the missing
+    archives. Errors are reported per archive and do not stop the other conversions.
+    """
+    sgx_files = sorted(filename for filename in os.listdir(DATA_DATASET) if filename.endswith('.sgx'))
     csv_files = [filename for filename in os.listdir(DATA_DATASET) if filename.endswith('.csv')]
     zip_exports_path = DATA_DATASET / "zip_exports"
+    manifest_path = zip_exports_path / "conversions.json"
     
     print(f'Found {len(sgx_files)} SGX files.')
     if len(sgx_files) == 0 and len(csv_files) == 0:
@@ -120,21 +250,46 @@ def convert_sgx_to_csv():
         return
     else:
         print('Starting conversion...\n')
-    
-    for i, sgx_file in enumerate(sgx_files):
-        print(f'Converting file {i + 1}/{len(sgx_files)}...')
-        zip_file = sgx_file.replace('.sgx', '.zip')
-        shutil.move(DATA_DATASET / sgx_file, DATA_DATASET / zip_file)
-        exported_file_name = DATA_DATASET / "{:04d}.csv".format(i)
-
-        model_json_df = convert_sgx_export(str(DATA_DATASET / zip_file))
-        model_json_df.to_csv(exported_file_name, sep=",", index=False)
-
-        if os.path.exists(DATA_DATASET / "ExtractedSGXExport"):
-            shutil.rmtree(DATA_DATASET / "ExtractedSGXExport")
-        if not os.path.exists(zip_exports_path):
-            os.makedirs(zip_exports_path, exist_ok=True)
-        shutil.move(DATA_DATASET / zip_file, zip_exports_path / zip_file)
-        print('\033[92m\u2713\033[0m Conversion successful\n')
-    
-    print('All SGX archives succesfully converted.')
+
+    os.makedirs(zip_exports_path, exist_ok=True)
+    manifest = _load_conversion_manifest(manifest_path)
+    numbers = [int(f[:-4]) for f in csv_files if re.fullmatch("[0-9]+.csv", f)]
+    numbers += [int(entry['csv'][:-4]) for entry in manifest.values()]
+    next_number = max(numbers, default=-1) + 1
+    for sgx_file in sgx_files:
+        if sgx_file not in manifest:
+            manifest[sgx_file] = {'csv': "{:04d}.csv".format(next_number), 'status': 'pending'}
+            next_number += 1
+    _save_conversion_manifest(manifest, manifest_path)
+
+    def archive(sgx_file):
+        shutil.move(DATA_DATASET / sgx_file, zip_exports_path / (sgx_file[:-len('.sgx')] + '.zip'))
+
+    jobs = []
+    for sgx_file in sgx_files:
+        entry = manifest[sgx_file]
+        if entry['status'] == 'done' and os.path.exists(DATA_DATASET / entry['csv']):
+            print(f'Skipping {sgx_file}, it has already been converted to {entry["csv"]}')
+            archive(sgx_file)
+        else:
+            jobs.append((sgx_file, DATA_DATASET / sgx_file, DATA_DATASET / entry['csv']))
+
+    failed = []
+    for i, (sgx_file, n_models, error) in enumerate(_iter_sgx_conversions(jobs, n_workers)):
+        entry = manifest[sgx_file]
+        if error is None:
+            entry.update(status='done', models=n_models)
+            entry.pop('error', None)
+            archive(sgx_file)
+            print(f'\033[92m\u2713\033[0m {i + 1}/{len(jobs)} Converted {sgx_file} to {entry["csv"]} ({n_models} models)')
+        else:
+            entry.update(status='failed', error=repr(error))
+            failed.append(sgx_file)
+            print(f'\033[91m\u2717\033[0m {i + 1}/{len(jobs)} Conversion of {sgx_file} failed: {error!r}')
+        _save_conversion_manifest(manifest, manifest_path)
+
+    if failed:
+        print(f'\n{len(failed)} SGX archives could not be converted: {", ".join(failed)}. '
+              'Run the conversion again to retry them.')
+    else:
+        print('\nAll SGX archives succesfully converted.')
@@ -1,9 +1,19 @@
+import os
 import sys
-import requests
+import json
 import time
-from SignavioAuthenticator import *
+import requests
+from collections import deque
+from RateLimiter import RateLimiter
+from SignavioClient import SignavioClient
 from urllib.parse import urlparse
-from conf import *
+from sapsam.constants import DATA_INTERIM
+
+# rename requests are limited to 50 per minute (formerly a fixed pause of 1.2 s after each request)
+RENAME_RATE_LIMITER = RateLimiter(50, 60)
+# fixed locations, so that a run from another working directory resumes the same plan instead of starting over
+RENAME_PLAN_PATH = DATA_INTERIM / 'rename_plan.json'
+RENAME_JOURNAL_PATH = DATA_INTERIM / 'rename_journal.jsonl'
 
 def get_root_dir_ids(response):
     root_dir_ids = {}
@@ -31,43 +41,166 @@ def get_latest_rev(response):
             href = href.replace("/revision/", "")
             return href
 
-def change_dir_names(folder_ids: list, dir_url, cookies, headers):
-    n = 0
-    for folder_id in folder_ids:
-        data = {'name': f'd{n}', 'description': ''}
-        change_dir_name_request = requests.put(
-            dir_url + f'/{folder_id}' + '/info',
-            cookies=cookies,
-            headers=headers,
-            data=data)
-        if change_dir_name_request.status_code == 200:
-            print(f"Successfully renamed folder with ID {folder_id}")
-        else:
-            print(f"Error while renaming folder with ID {folder_id}")
-            break
-        n += 1
-        time.sleep(1.2)
-
-def change_mod_names(model_ids: list, mod_url, cookies, headers):
-    n = 0
-    for model_id in model_ids:
-        data = {'name': f'm{n}'}
-        change_mod_name_request = requests.put(
-            mod_url + f'/{model_id}' + '/info',
-            cookies=cookies,
-            headers=headers,
-            data=data)
-        if change_mod_name_request.status_code == 200:
-            print(f"Successfully renamed model with ID {model_id}")
+def list_object_ids(client, dir_url, dir_id, recursive=False):
+    """
+    Lists the IDs of the folders and models in the directory dir_id, with recursive also of all subdirectories
+    (breadth first). Returns None if a directory cannot be listed.
+    """
+    folder_ids, model_ids = [], []
+    visited = {dir_id}
+    queue = deque([dir_id])
+    while queue:
+        current_id = queue.popleft()
+        list_ids_request = client.get(dir_url + '/' + current_id)
+        response_status = list_ids_request.status_code
+        if response_status != 200:
+            print(f"API error: expected 200 but received {response_status} from server for directory {current_id}")
+            return None
+        for entry in list_ids_request.json():
+            path = urlparse(entry.get("href", "")).path
+            if path.startswith("/directory/"):
+                # the listing also links the directory itself (and its parent), which are already visited
+                folder_id = path.split("/directory/")[-1]
+                if folder_id not in visited:
+                    visited.add(folder_id)
+                    folder_ids.append(folder_id)
+                    if recursive:
+                        queue.append(folder_id)
+            elif path.startswith("/model/"):
+                model_ids.append(path.split("/model/")[-1])
+    return folder_ids, model_ids
+
+def plan_renames(folder_ids: list, model_ids: list):
+    """
+    Maps the folders to the names d0, d1, ... and the models to the names m0, m1, ...
+    """
+    renames = [{'type': 'directory', 'id': folder_id, 'name': f'd{n}'} for n, folder_id in enumerate(folder_ids)]
+    renames += [{'type': 'model', 'id': model_id, 'name': f'm{n}'} for n, model_id in enumerate(model_ids)]
+    return renames
+
+def load_rename_plan(plan_path=RENAME_PLAN_PATH):
+    """
+    Returns the stored plan ({'recursive': bool, 'renames': [...]}) or None if there is none. Plans that only
+    stored the renames have recursive None.
+    """
+    if not os.path.exists(plan_path):
+        return None
+    with open(plan_path) as f:
+        plan = json.load(f)
+    if isinstance(plan, list):
+        return {'recursive': None, 'renames': plan}
+    return plan
+
+def save_rename_plan(renames: list, recursive: bool, plan_path=RENAME_PLAN_PATH):
+    # the plan is fixed on the first run, so that resumed runs assign the same names even if the listing changed
+    os.makedirs(os.path.dirname(plan_path), exist_ok=True)
+    tmp_path = str(plan_path) + '.part'
+    with open(tmp_path, 'w') as f:
+        json.dump({'recursive': recursive, 'renames': renames}, f, indent=1)
+    os.replace(tmp_path, plan_path)
+
+def load_renamed_ids(journal_path=RENAME_JOURNAL_PATH):
+    if not os.path.exists(journal_path):
+        return set()
+    with open(journal_path) as f:
+        return {json.loads(line)['id'] for line in f if line.strip()}
+
+def put_with_retries(client, url, data, rate_limiter, max_retries=3, backoff=2.0):
+    """
+    Sends a PUT request within the rate budget (429 responses are retried by the client). Server errors and
+    connection errors are retried up to max_retries times, waiting backoff, 2 * backoff, 4 * backoff, ... seconds.
+    Returns True if the request succeeded.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            response = client.put(url, data=data, rate_limiter=rate_limiter)
+            if response.status_code == 200:
+                return True
+            if response.status_code < 500 and response.status_code != 429:
+                print(f"API error: expected 200 but received {response.status_code} from server")
+                return False
+            reason = f"received {response.status_code} from server"
+        except requests.RequestException as e:
+            reason = str(e)
+        if attempt < max_retries:
+            wait = backoff * 2 ** attempt
+            print(f"Request failed ({reason}), retrying in {wait:.0f} s")
+            time.sleep(wait)
+    return False
+
+def rename_objects(renames: list, client, dir_url, mod_url, rate_limiter=RENAME_RATE_LIMITER,
+                   journal_path=RENAME_JOURNAL_PATH):
+    """
+    Renames the folders and models of the plan. Every successful rename is appended to the journal, renames that
+    are in the journal already are skipped, so an interrupted run is resumed by running it again. Failed renames
+    do not stop the run, they are retried on the next run. Returns the number of renamed and failed objects.
+    """
+    renamed_ids = load_renamed_ids(journal_path)
+    n_renamed, n_failed = 0, 0
+    os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+    with open(journal_path, 'a') as journal:
+        for rename in renames:
+            if rename['id'] in renamed_ids:
+                continue
+            if rename['type'] == 'directory':
+                url = dir_url + f"/{rename['id']}" + '/info'
+                data = {'name': rename['name'], 'description': ''}
+                label = 'folder'
+            else:
+                url = mod_url + f"/{rename['id']}" + '/info'
+                data = {'name': rename['name']}
+                label = 'model'
+            if put_with_retries(client, url, data, rate_limiter):
+                journal.write(json.dumps({'id': rename['id'], 'name': rename['name']}) + '\n')
+                journal.flush()
+                print(f"Successfully renamed {label} with ID {rename['id']}")
+                n_renamed += 1
+            else:
+                print(f"Error while renaming {label} with ID {rename['id']}")
+                n_failed += 1
+    return n_renamed, n_failed
+
+def rename(client, dir_url, mod_url, root_dir_id, recursive=False, dry_run=True):
+    """
+    Renames the folders and models below the root directory as planned by plan_renames. The plan is stored in
+    RENAME_PLAN_PATH on the first run (also for a dry run) together with recursive and reused by later runs with
+    the same recursive option, delete the plan and RENAME_JOURNAL_PATH to start over. A dry run only prints the
+    planned ID -> name mapping.
+    """
+    plan = load_rename_plan()
+    if plan is None:
+        object_ids = list_object_ids(client, dir_url, root_dir_id, recursive)
+        if object_ids is None:
+            return
+        renames = plan_renames(*object_ids)
+        save_rename_plan(renames, recursive)
+    elif plan['recursive'] != recursive:
+        # a resumed run must rename the objects of the plan, not silently a different set of objects
+        if plan['recursive'] is None:
+            print(f"The existing rename plan {RENAME_PLAN_PATH} does not record whether it was made with "
+                  f"--recursive, delete it to plan again.")
         else:
-            print(f"Error while renaming model with ID {model_id}")
-            break
-        n += 1
-        time.sleep(1.2)
+            print(f"The existing rename plan {RENAME_PLAN_PATH} was made {'with' if plan['recursive'] else 'without'} "
+                  f"--recursive. Pass the same options to resume it, or delete it to plan again.")
+        return
+    else:
+        renames = plan['renames']
+        print(f"Using the existing rename plan {RENAME_PLAN_PATH}")
+    renamed_ids = load_renamed_ids()
+    print(f"{len(renames)} objects planned, {len(renamed_ids)} already renamed")
+    if dry_run:
+        for rename in renames:
+            status = 'done' if rename['id'] in renamed_ids else 'planned'
+            print(f"{rename['type']} {rename['id']} -> {rename['name']} ({status})")
+        print("Dry run, nothing renamed (pass --execute to rename)")
+        return
+    n_renamed, n_failed = rename_objects(renames, client, dir_url, mod_url)
+    print(f"Renamed {n_renamed} objects, {n_failed} failed")
 
 def main():
     if len(sys.argv) < 2:
         print("Script requires an argument: 'rename' or 'fetch' or 'conventions'")
+        print("rename options: --recursive (include subdirectories), --execute (rename instead of a dry run)")
         return
     if sys.argv[1] == 'rename' or sys.argv[1] == 'fetch' or sys.argv[1] == 'conventions':
         pass
@@ -75,19 +208,14 @@ def main():
         print("Unknown argument")
         return
 
-    auth_data = SignavioAuthenticator.authenticate()
-    dir_url = system_instance + '/p/directory'
-    mod_url = system_instance + '/p/model'
-    rev_url = system_instance + '/p/revision'
-    bp_check_url = system_instance + '/p/mgeditorchecker'
+    client = SignavioClient()
+    dir_url = '/p/directory'
+    mod_url = '/p/model'
+    rev_url = '/p/revision'
+    bp_check_url = '/p/mgeditorchecker'
     target_dir_name = "Shared documents"
-    cookies = {'JSESSIONID': auth_data['jsesssion_ID'], 'LBROUTEID': auth_data['lb_route_ID']}
-    headers = {'Accept': 'application/json', 'X-Signavio-ID': auth_data['auth_token']}
 
-    get_dir_meta_request = requests.get(
-        dir_url,
-        cookies=cookies,
-        headers=headers)
+    get_dir_meta_request = client.get(dir_url)
     response_status = get_dir_meta_request.status_code
     if response_status != 200:
         print(f"API error: expected 200 but received {response_status} from server")
@@ -96,39 +224,18 @@ def main():
     root_dir_ids = get_root_dir_ids(response)
 
     if sys.argv[1] == 'rename':
-        list_all_ids = requests.get(
-            dir_url + '/' + root_dir_ids[target_dir_name],
-            cookies=cookies,
-            headers=headers)
-        response_status = list_all_ids.status_code
-        if response_status != 200:
-            print(f"API error: expected 200 but received {response_status} from server")
-            return
-        response = list_all_ids.json()
-        folder_ids = get_object_ids(response, target_dir_name, root_dir_ids, "/directory/")
-        #change_dir_names(folder_ids, dir_url, cookies, headers)
-
-        model_ids = get_object_ids(response, target_dir_name, root_dir_ids, "/model/")
-        #change_mod_names(model_ids, mod_url, cookies, headers)
-        print("Function currently deactivated")
+        # renaming is irreversible, without --execute only the planned mapping is printed
+        rename(client, dir_url, mod_url, root_dir_ids[target_dir_name],
+               recursive='--recursive' in sys.argv[2:], dry_run='--execute' not in sys.argv[2:])
     elif sys.argv[1] == 'fetch':
-        fetch_diagram = requests.post(
-            mod_url + '/10ac4ca1ccfc4c7cb8de451d92ba04aa/json',
-            cookies=cookies,
-            headers=headers)
+        fetch_diagram = client.post(mod_url + '/10ac4ca1ccfc4c7cb8de451d92ba04aa/json')
         print(fetch_diagram.text)
     elif sys.argv[1] == 'conventions':
-        #get_guideline_id = requests.get()
-        get_diagram_revisions = requests.get(
-            mod_url + '/10ac4ca1ccfc4c7cb8de451d92ba04aa/revisions',
-            cookies=cookies,
-            headers=headers)
+        #get_guideline_id = client.get()
+        get_diagram_revisions = client.get(mod_url + '/10ac4ca1ccfc4c7cb8de451d92ba04aa/revisions')
         rev_id = get_latest_rev(get_diagram_revisions.json())
 
-        get_diagram_request = requests.get(
-            rev_url + '/' + rev_id + '/json',
-            cookies=cookies,
-            headers=headers)
+        get_diagram_request = client.get(rev_url + '/' + rev_id + '/json')
 
         data = {'comments': '{}',
                 'guidelineId': '4551c2229baa4c79a151b5a0cc1010d2', #to do next, find out how to retrieve guidelineid
@@ -138,10 +245,8 @@ def main():
                 'id': '10ac4ca1ccfc4c7cb8de451d92ba04aa',
                 'checkLinking': 'false'}
 
-        bp_check_request = requests.post(
+        bp_check_request = client.post(
             bp_check_url,
-            cookies=cookies,
-            headers=headers,
             data=data)
 
         rep_data = bp_check_request.json().get('rep', [])
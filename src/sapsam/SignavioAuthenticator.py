@@ -6,22 +6,25 @@ class SignavioAuthenticator:
     Takes care of authentication against Signavio systems
     """
 
-    def authenticate():
+    def authenticate(session=None, instance=None):
         """
         Authenticates user at Signavio system instance and initiates session.
+        Args:
+            session (requests.Session): Session that sends the login request and keeps its cookies.
+                                        Default: None (plain request)
+            instance (str): URL of the system instance. Default: system_instance of the conf file
         Returns:
             dictionary: Session information
         """
-        login_url = system_instance + '/p/login'
-        data = {
-            'name': email,
-            'password': pw,
-            'tokenonly': 'true',
-            'tenant': tenant_id
-        }
+        if session is None:
+            session = requests
+        if instance is None:
+            instance = system_instance
+        login_url = instance + '/p/login'
+        data = SignavioAuthenticator.get_login_data()
     
         # authenticate
-        login_request = requests.post(login_url, data)
+        login_request = session.post(login_url, data)
 
         # retrieve token and session ID
         auth_token = login_request.content.decode('utf-8')
@@ -38,3 +41,16 @@ class SignavioAuthenticator:
             'lb_route_ID': lb_route_ID,
             'auth_token': auth_token
         }
+
+    def get_login_data():
+        """
+        Returns the form data of the login request, with the credentials of the conf file.
+        Returns:
+            dictionary: Login form data
+        """
+        return {
+            'name': email,
+            'password': pw,
+            'tokenonly': 'true',
+            'tenant': tenant_id
+        }
@@ -0,0 +1,201 @@
+import time
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from sapsam.conf import system_instance
+from sapsam.SignavioAuthenticator import SignavioAuthenticator
+
+_logger = logging.getLogger(__name__)
+
+class SignavioClient:
+    """
+    Sends requests to a Signavio system instance through one pooled requests.Session, so that connections are
+    reused across requests. The credentials of the login are cached and the client re-authenticates transparently
+    if the server answers with 401 (expired session) or if the session is older than session_ttl seconds.
+    Requests that are rejected with 429 (too many requests) are retried after the Retry-After time.
+    """
+
+    def __init__(self, instance=None, pool_size=10, session_ttl=None, rate_limiter=None, max_retries=3,
+                 auth_data=None):
+        """
+        Args:
+            instance (str): URL of the system instance. Default: system_instance of the conf file
+            pool_size (int): Maximum number of pooled connections, should be at least the number of threads
+                             that share the client. Default: 10
+            session_ttl (float): Seconds after which the client logs in again before sending a request.
+                                 Default: None (only re-authenticate on 401)
+            rate_limiter (RateLimiter): Limits all requests of the client, can be overridden per request.
+                                        Default: None (no limit)
+            max_retries (int): Number of retries of a request rejected with 429. Default: 3
+            auth_data (dict): Credentials of an existing login (see SignavioAuthenticator.authenticate) that are
+                              used until the server rejects them. Default: None (log in on the first request)
+        """
+        self.instance = instance if instance is not None else system_instance
+        self.session_ttl = session_ttl
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Accept'] = 'application/json'
+        self._auth_data = None
+        self._auth_time = None
+        self._auth_lock = threading.Lock()
+        if auth_data is not None:
+            self.session.cookies.set('JSESSIONID', auth_data['jsesssion_ID'])
+            self.session.cookies.set('LBROUTEID', auth_data['lb_route_ID'])
+            self._set_auth_data(auth_data)
+
+    def _set_auth_data(self, auth_data):
+        self.session.headers['x-signavio-id'] = auth_data['auth_token']
+        self._auth_data = auth_data
+        self._auth_time = time.monotonic()
+
+    def authenticate(self, expired=None):
+        """Logs in and stores the credentials in the session (cookies and x-signavio-id header).
+
+        Args:
+            expired (dict): Credentials that were rejected by the server. If another thread has re-authenticated
+                            in the meantime, its credentials are used instead of logging in again.
+
+        Returns:
+            dictionary: Session information, see SignavioAuthenticator.authenticate
+        """
+        with self._auth_lock:
+            if self._auth_data is None or self._auth_data is expired:
+                # the login response sets the JSESSIONID and LBROUTEID cookies in the session's cookie jar
+                self._set_auth_data(SignavioAuthenticator.authenticate(self.session, self.instance))
+            return self._auth_data
+
+    def get_auth_data(self):
+        """Returns the cached credentials, logs in first if there are none or if they are older than session_ttl.
+
+        Returns:
+            dictionary: Session information, see SignavioAuthenticator.authenticate
+        """
+        auth_data = self._auth_data
+        if auth_data is None:
+            return self.authenticate()
+        if self.session_ttl is not None and time.monotonic() - self._auth_time > self.session_ttl:
+            return self.authenticate(expired=auth_data)
+        return auth_data
+
+    def _get_url(self, path):
+        return path if urlparse(path).scheme else self.instance + path
+
+    def request(self, method, path, rate_limiter=None, **kwargs):
+        """Sends a request with the session credentials. The request is retried once after re-authenticating on 401
+        and up to max_retries times after waiting for the Retry-After time on 429. With a rate limiter, the wait
+        blocks all requests that share the limiter.
+
+        Args:
+            method (str): HTTP method
+            path (str): Path relative to the system instance (e.g. '/p/model') or absolute URL
+            rate_limiter (RateLimiter): Limiter for this request. Default: None (rate_limiter of the client)
+            kwargs: Passed to requests.Session.request
+
+        Returns:
+            requests.Response
+        """
+        if rate_limiter is None:
+            rate_limiter = self.rate_limiter
+        auth_data = self.get_auth_data()
+        reauthenticated = False
+        retries = 0
+        while True:
+            if rate_limiter is not None:
+                rate_limiter.acquire()
+            response = self.session.request(method, self._get_url(path), **kwargs)
+            if response.status_code == 401 and not reauthenticated:
+                _logger.info("Session expired, re-authenticating")
+                auth_data = self.authenticate(expired=auth_data)
+                reauthenticated = True
+                continue
+            if response.status_code != 429 or retries >= self.max_retries:
+                return response
+            retry_after = get_retry_after(response, default=2 ** retries)
+            retries += 1
+            _logger.info("Rate limit exceeded, retrying in %.1f s", retry_after)
+            if rate_limiter is not None:
+                rate_limiter.pause(retry_after)
+            else:
+                time.sleep(retry_after)
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def get_retry_after(response, default=1.0):
+    """Returns the seconds to wait according to the Retry-After header of a response (seconds or HTTP date)
+
+    Returns:
+        float: Seconds to wait, default if the header is missing or invalid
+    """
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is None:
+        return default
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+_shared_client = None
+# clients of the logins whose auth_data was passed to resolve_client, by auth token
+_auth_data_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client():
+    """
+    Returns the client that is shared by RepresentationGenerator and the convention checkers if they are not given
+    a client, so that all of them use one login and one connection pool.
+    """
+    global _shared_client
+    with _clients_lock:
+        if _shared_client is None:
+            _shared_client = SignavioClient()
+        return _shared_client
+
+def resolve_client(client=None):
+    """
+    Returns the client to send the requests of RepresentationGenerator and the convention checkers with, client
+    is either a SignavioClient, the auth_data of SignavioAuthenticator.authenticate (which they took before there
+    was a client, all calls with the same auth_data share one client) or None (the client of get_client).
+
+    Returns:
+        SignavioClient: Client
+    """
+    if client is None:
+        return get_client()
+    if isinstance(client, dict):
+        with _clients_lock:
+            if client['auth_token'] not in _auth_data_clients:
+                _auth_data_clients[client['auth_token']] = SignavioClient(auth_data=client)
+            return _auth_data_clients[client['auth_token']]
+    return client
@@ -1,9 +1,27 @@
-import requests
-import time
-from sapsam.SignavioAuthenticator import *
-from urllib.parse import urlparse
-from sapsam.conf import *
+import os
+import csv
 import json
+import logging
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+from sapsam import syntax
+from sapsam.CheckResultCache import get_check_cache
+from sapsam.constants import BPMN2_NAMESPACE, DATA_CONVENTIONS
+from sapsam.RateLimiter import RateLimiter
+from sapsam.SignavioClient import resolve_client
+
+_logger = logging.getLogger(__name__)
+
+# limitation for API calls (50/minute), shared by all checks of the process
+CONVENTIONS_RATE_LIMITER = RateLimiter(50, 60)
+
+CONVENTIONS_CSV_COLUMNS = ['model_id', 'name', 'syntax_errors', 'bp_violations']
+
+# 'remote': Signavio syntax checker, 'local': local rules of syntax.check_model_syntax only,
+# 'hybrid': local rules, remote syntax checker for the models the local rules cannot decide. The local rules are a
+# subset of the remote checks with their own rule names, local results are tagged with "source": "local"
+SYNTAX_MODES = ['remote', 'local', 'hybrid']
 
 def get_latest_rev(response):
     for entry in response:
@@ -12,19 +30,39 @@ def get_latest_rev(response):
             href = href.replace("/revision/", "")
             return href
 
-def syntax_checker(model_json, auth_data):
-    #auth_data = SignavioAuthenticator.authenticate()
-    syntax_check_url = system_instance + '/p/syntaxchecker'
-    cookies = {'JSESSIONID': auth_data['jsesssion_ID'], 'LBROUTEID': auth_data['lb_route_ID']}
-    headers = {'Accept': 'application/json', 'X-Signavio-ID': auth_data['auth_token']}
+def syntax_checker(model_json, client=None, rate_limiter=None, use_cache=True, cache=None, mode='remote',
+                   auth_data=None):
+    # client is a SignavioClient or, like auth_data, the credentials of SignavioAuthenticator.authenticate
+    # (see SignavioClient.resolve_client), mode is one of SYNTAX_MODES, the local rules neither need the API nor
+    # the cache
+    if auth_data is not None:
+        client = auth_data
+    if mode not in SYNTAX_MODES:
+        raise ValueError(f"Unknown syntax mode: {mode}, available modes: {SYNTAX_MODES}")
+    if mode != 'remote':
+        syntax_errors = syntax.check_model_syntax(model_json)
+        if syntax_errors is not None:
+            return json.dumps(syntax_errors)
+        if mode == 'local':
+            return None
+    # with use_cache, results are looked up in cache (by default get_check_cache()) before calling the API
+    if use_cache:
+        cache = cache if cache is not None else get_check_cache()
+        return cache.get_or_compute('syntax', [model_json, BPMN2_NAMESPACE],
+                                    lambda: _syntax_checker(model_json, client, rate_limiter))
+    return _syntax_checker(model_json, client, rate_limiter)
+
+def _syntax_checker(model_json, client, rate_limiter):
+    # without a client, the client shared within the process is used (one login for all checks)
+    client = resolve_client(client)
+    if rate_limiter is None:
+        rate_limiter = CONVENTIONS_RATE_LIMITER
+    syntax_check_url = '/p/syntaxchecker'
     '''
     # Uncomment and adapt this part for using the function directly in a workspace
-    mod_url = system_instance + '/p/model'
-    rev_url = system_instance + '/p/revision'
-    get_diagram_request = requests.get(
-        rev_url + '/' + rev_id + '/json',
-        cookies=cookies,
-        headers=headers)
+    mod_url = '/p/model'
+    rev_url = '/p/revision'
+    get_diagram_request = client.get(rev_url + '/' + rev_id + '/json')
     response_status = get_diagram_request.status_code
     if response_status != 200:
         print(f"API error: expected 200 but received {response_status} from server")
@@ -32,13 +70,12 @@ def syntax_checker(model_json, auth_data):
     '''
     data = {'isJson': 'true',
             'data_json': model_json,
-            'ns': 'http://b3mn.org/stencilset/bpmn2.0#'}
+            'ns': BPMN2_NAMESPACE}
 
-    syntax_check_request = requests.post(
+    syntax_check_request = client.post(
         syntax_check_url,
-        cookies=cookies,
-        headers=headers,
-        data=data)
+        data=data,
+        rate_limiter=rate_limiter)
     response_status = syntax_check_request.status_code
     if response_status != 200:
         print(f"API error: expected 200 but received {response_status} from server")
@@ -49,33 +86,41 @@ def syntax_checker(model_json, auth_data):
         'errors': rep_data[0].get('must', []),
         'warnings': rep_data[0].get('should', []),
     }
-    time.sleep(0.8) # limitation for API calls (50/minute)
     return json.dumps(syntax_errors)
     
 
-def bp_conventions_checker(name:str, model_id: str, guideline_id: str, model_json, auth_data):
-    #auth_data = SignavioAuthenticator.authenticate()
-    bp_check_url = system_instance + '/p/mgeditorchecker'
-    cookies = {'JSESSIONID': auth_data['jsesssion_ID'], 'LBROUTEID': auth_data['lb_route_ID']}
-    headers = {'Accept': 'application/json', 'X-Signavio-ID': auth_data['auth_token']}
+def bp_conventions_checker(name:str, model_id: str, guideline_id: str, model_json, client=None, rate_limiter=None,
+                           use_cache=True, cache=None, auth_data=None):
+    # client is a SignavioClient or, like auth_data, the credentials of SignavioAuthenticator.authenticate
+    if auth_data is not None:
+        client = auth_data
+    # with use_cache, results are looked up in cache (by default get_check_cache()) before calling the API,
+    # the model name is part of the key as naming conventions are checked against it
+    if use_cache:
+        cache = cache if cache is not None else get_check_cache()
+        return cache.get_or_compute('bp_conventions', [model_json, guideline_id, name],
+                                    lambda: _bp_conventions_checker(name, model_id, guideline_id, model_json,
+                                                                    client, rate_limiter))
+    return _bp_conventions_checker(name, model_id, guideline_id, model_json, client, rate_limiter)
+
+def _bp_conventions_checker(name, model_id, guideline_id, model_json, client, rate_limiter):
+    # without a client, the client shared within the process is used (one login for all checks)
+    client = resolve_client(client)
+    if rate_limiter is None:
+        rate_limiter = CONVENTIONS_RATE_LIMITER
+    bp_check_url = '/p/mgeditorchecker'
     '''
     # Uncomment and adapt this part for using the function directly in a workspace
-    mod_url = system_instance + '/p/model'
-    rev_url = system_instance + '/p/revision'
-    get_diagram_revisions = requests.get(
-        mod_url + '/' + model_id + '/revisions',
-        cookies=cookies,
-        headers=headers)
+    mod_url = '/p/model'
+    rev_url = '/p/revision'
+    get_diagram_revisions = client.get(mod_url + '/' + model_id + '/revisions')
     response_status = get_diagram_revisions.status_code
     if response_status != 200:
         print(f"API error: expected 200 but received {response_status} from server")
         return
     #rev_id = get_latest_rev(get_diagram_revisions.json())
     
-    get_diagram_request = requests.get(
-        rev_url + '/' + rev_id + '/json',
-        cookies=cookies,
-        headers=headers)
+    get_diagram_request = client.get(rev_url + '/' + rev_id + '/json')
     response_status = get_diagram_request.status_code
     if response_status != 200:
         print(f"API error: expected 200 but received {response_status} from server")
@@ -88,11 +133,10 @@ def bp_conventions_checker(name:str, model_id: str, guideline_id: str, model_jso
             'id': model_id,
             'checkLinking': 'false'}
 
-    bp_check_request = requests.post(
+    bp_check_request = client.post(
         bp_check_url,
-        cookies=cookies,
-        headers=headers,
-        data=data)
+        data=data,
+        rate_limiter=rate_limiter)
     response_status = bp_check_request.status_code
     if response_status != 200:
         print(f"API error: expected 200 but received {response_status} from server")
@@ -104,5 +148,61 @@ def bp_conventions_checker(name:str, model_id: str, guideline_id: str, model_jso
         'warnings': len(rep_data[0].get('should', [])),
         'info': len(rep_data[0].get('info', []))
     }
-    time.sleep(0.8) # limitation for API calls (50/minute)
-    return json.dumps(violations_count)
\ No newline at end of file
+    return json.dumps(violations_count)
+
+def _check_model(model_id, name, model_json, guideline_id, client, rate_limiter, use_cache, cache, syntax_mode):
+    syntax_errors = syntax_checker(model_json, client, rate_limiter, use_cache, cache, syntax_mode)
+    violations_count = bp_conventions_checker(name, model_id, guideline_id, model_json, client, rate_limiter,
+                                              use_cache, cache)
+    return {'model_id': model_id, 'name': name, 'syntax_errors': syntax_errors, 'bp_violations': violations_count}
+
+def _read_checked_model_ids(out_path):
+    if not os.path.exists(out_path):
+        return set()
+    with open(out_path, newline='', encoding='utf-8') as f:
+        return {row['model_id'] for row in csv.DictReader(f)}
+
+def check_conventions(df, guideline_id: str, out_path=None, client=None, rate_limiter=None, n_workers=4,
+                      use_cache=True, cache=None, syntax_mode='remote'):
+    """
+    Runs the syntax and the BP conventions check for every model of df (as returned by parser.parse_model) and
+    appends one row per model to out_path, the csv read by parser.parse_conventions (columns
+    CONVENTIONS_CSV_COLUMNS, the check results as JSON). n_workers threads send the requests concurrently, the rate
+    limiter (by default CONVENTIONS_RATE_LIMITER) keeps them within the API limit. Every row is written as soon as
+    its checks are done, models that are already in out_path are skipped, so an interrupted run is resumed by
+    calling check_conventions again. Models whose checks fail are not written and retried on the next call.
+    See syntax_checker for use_cache, cache and syntax_mode, a cache in offline mode writes only the models with
+    cached results.
+    Returns the number of checked models.
+    """
+    if out_path is None:
+        out_path = DATA_CONVENTIONS / 'conventions.csv'
+    client = resolve_client(client)
+    if rate_limiter is None:
+        rate_limiter = CONVENTIONS_RATE_LIMITER
+    checked_model_ids = _read_checked_model_ids(out_path)
+    df = df[~df.index.isin(checked_model_ids)]
+    _logger.info("Checking %d models, %d already checked", len(df), len(checked_model_ids))
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    write_header = not checked_model_ids and not os.path.exists(out_path)
+    n_checked = 0
+    with open(out_path, 'a', newline='', encoding='utf-8') as f, ThreadPoolExecutor(n_workers) as executor:
+        writer = csv.DictWriter(f, fieldnames=CONVENTIONS_CSV_COLUMNS, lineterminator='\n')
+        if write_header:
+            writer.writeheader()
+        futures = {executor.submit(_check_model, model_id, name, model_json, guideline_id, client, rate_limiter,
+                                   use_cache, cache, syntax_mode):
+                   model_id for model_id, name, model_json in df[['name', 'model_json']].itertuples()}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                result = future.result()
+            except (requests.RequestException, ValueError, IndexError):
+                _logger.exception("Checks of model %s failed", futures[future])
+                continue
+            if result['syntax_errors'] is None or result['bp_violations'] is None:
+                _logger.warning("Checks of model %s failed", result['model_id'])
+                continue
+            writer.writerow(result)
+            f.flush()
+            n_checked += 1
+    return n_checked
@@ -0,0 +1,79 @@
+import os
+import json
+import hashlib
+import logging
+import shutil
+from pathlib import Path
+from typing import Callable, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from sapsam.constants import DATA_CACHE
+
+_logger = logging.getLogger(__name__)
+
+# key of the parquet schema metadata entry that stores the source csv the file was built from
+_SOURCE_KEY = b"sapsam_source"
+
+def _source_key(csv_path: Path) -> dict:
+    stat = os.stat(csv_path)
+    return {"path": str(Path(csv_path).resolve()), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def get_cache_path(csv_path: Path, kind: str, cache_root=DATA_CACHE) -> Path:
+    """
+    Returns the parquet file that caches the parsed content of csv_path. kind separates different parse results
+    of the same csv (e.g. metadata and model elements), the hash of the csv path keeps csvs with the same name
+    from different dataset folders apart.
+    """
+    path_hash = hashlib.sha1(str(Path(csv_path).resolve()).encode("utf-8")).hexdigest()[:10]
+    return Path(cache_root) / kind / f"{Path(csv_path).stem}-{path_hash}.parquet"
+
+def is_fresh(csv_path: Path, kind: str, cache_root=DATA_CACHE) -> bool:
+    """
+    A cache file is fresh if it was built from a csv with the same path, size and modification time.
+    Only the parquet footer is read for this check.
+    """
+    cache_path = get_cache_path(csv_path, kind, cache_root)
+    if not cache_path.exists():
+        return False
+    try:
+        metadata = pq.read_schema(cache_path).metadata or {}
+    except (OSError, pa.ArrowException):
+        _logger.warning("Ignoring unreadable cache file %s", cache_path)
+        return False
+    return metadata.get(_SOURCE_KEY) == json.dumps(_source_key(csv_path)).encode("utf-8")
+
+def write_cache(df: pd.DataFrame, csv_path: Path, kind: str, cache_root=DATA_CACHE) -> Path:
+    cache_path = get_cache_path(csv_path, kind, cache_root)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    table = pa.Table.from_pandas(df)
+    metadata = dict(table.schema.metadata or {})
+    metadata[_SOURCE_KEY] = json.dumps(_source_key(csv_path)).encode("utf-8")
+    # write to a temporary file first so that concurrent readers never see a partially written cache file
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+    pq.write_table(table.replace_schema_metadata(metadata), tmp_path)
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+def load_cached(csv_path: Path, kind: str, build: Callable[[Path], pd.DataFrame], columns: Optional[List[str]] = None,
+                cache_root=DATA_CACHE) -> pd.DataFrame:
+    """
+    Returns the cached parse result of csv_path, calling build(csv_path) and caching its result if the cache file
+    is missing or stale. With columns only these columns (plus the index) are read from the cache file.
+    """
+    if is_fresh(csv_path, kind, cache_root):
+        return pd.read_parquet(get_cache_path(csv_path, kind, cache_root), columns=columns)
+    _logger.info("Building %s cache for %s", kind, csv_path)
+    df = build(csv_path)
+    write_cache(df, csv_path, kind, cache_root)
+    return df if columns is None else df[columns]
+
+def clear_cache(kind: Optional[str] = None, cache_root=DATA_CACHE):
+    """
+    Removes all cache files of the given kind, or the whole cache if kind is None.
+    """
+    path = Path(cache_root) if kind is None else Path(cache_root) / kind
+    if path.exists():
+        shutil.rmtree(path)
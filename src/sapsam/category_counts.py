@@ -0,0 +1,152 @@
+import logging
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from sapsam.parser import BpmnModelParser
+
+_logger = logging.getLogger(__name__)
+
+class CategoryCounts:
+    """
+    Sparse model x category matrix of element counts, the sparse counterpart of
+        df_cnts = df_elements.groupby("model_id").category.value_counts().unstack().fillna(0)
+    matrix[i, j] is the number of elements of category categories[j] in model model_ids[i], namespaces[i] is the
+    namespace of the model (if known). Built incrementally from the batches of BpmnModelParser.iter_model_elements:
+        counts = build_category_counts()
+        counts.frequency().head(20)
+        counts.for_namespace(BPMN2_NAMESPACE).correlation()
+    """
+
+    def __init__(self, matrix: sparse.csr_matrix, model_ids: pd.Index, categories: pd.Index,
+                 namespaces: Optional[np.ndarray] = None):
+        self.matrix = matrix
+        self.model_ids = model_ids
+        self.categories = categories
+        self.namespaces = namespaces
+
+    @classmethod
+    def from_elements(cls, df: pd.DataFrame) -> "CategoryCounts":
+        """
+        Counts the categories of elements parsed with BpmnModelParser, elements without category are not counted.
+        Models are the runs of consecutive rows with the same model id, like in the parser's output.
+        """
+        model_ids = df.index.get_level_values("model_id").to_numpy()
+        starts = np.flatnonzero(np.r_[True, model_ids[1:] != model_ids[:-1]]) if len(df) else np.array([], int)
+        rows = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(df))))
+        columns, categories = pd.factorize(df["category"].to_numpy(), sort=True)
+        counted = columns >= 0
+        matrix = sparse.csr_matrix((np.ones(counted.sum(), dtype=np.int32), (rows[counted], columns[counted])),
+                                   shape=(len(starts), len(categories)))
+        namespaces = df["namespace"].to_numpy()[starts] if "namespace" in df.columns else None
+        return cls(matrix, pd.Index(model_ids[starts], name="model_id"), pd.Index(categories, name="category"),
+                   namespaces)
+
+    @classmethod
+    def concat(cls, counts: List["CategoryCounts"]) -> "CategoryCounts":
+        """
+        Stacks the rows of the counts (e.g. of several batches), the categories are the union of their categories.
+        """
+        categories = pd.Index(sorted(set().union(*(c.categories for c in counts))), name="category")
+        matrices = []
+        for c in counts:
+            # maps the columns of c to the union of the categories
+            mapping = sparse.csr_matrix((np.ones(len(c.categories), dtype=np.int64),
+                                         (np.arange(len(c.categories)), categories.get_indexer(c.categories))),
+                                        shape=(len(c.categories), len(categories)))
+            matrices.append(c.matrix @ mapping)
+        namespaces = None
+        if counts and all(c.namespaces is not None for c in counts):
+            namespaces = np.concatenate([c.namespaces for c in counts])
+        return cls(
+            sparse.vstack(matrices, format="csr") if matrices else sparse.csr_matrix((0, 0), dtype=np.int32),
+            pd.Index(np.concatenate([c.model_ids.to_numpy() for c in counts]) if counts else [], name="model_id"),
+            categories, namespaces)
+
+    @property
+    def n_models(self) -> int:
+        return self.matrix.shape[0]
+
+    def select(self, rows: np.ndarray) -> "CategoryCounts":
+        """
+        Returns the counts of the rows (positions or a boolean mask), categories that do not occur in them are
+        dropped.
+        """
+        matrix = self.matrix[rows]
+        occurring = np.flatnonzero(matrix.getnnz(axis=0) > 0)
+        return CategoryCounts(matrix[:, occurring], self.model_ids[rows], self.categories[occurring],
+                              None if self.namespaces is None else self.namespaces[rows])
+
+    def for_namespace(self, namespace: str) -> "CategoryCounts":
+        if self.namespaces is None:
+            raise ValueError("The namespaces of the models are unknown, parse the elements with namespace=None")
+        return self.select(self.namespaces == namespace)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Returns the counts as DataFrame with sparse columns (which keeps the memory footprint of the matrix).
+        """
+        return pd.DataFrame.sparse.from_spmatrix(self.matrix, index=self.model_ids, columns=self.categories)
+
+    def frequency(self) -> pd.DataFrame:
+        """
+        Returns per category the number of elements, the number of models that contain it and their share of all
+        models, sorted by the number of elements.
+        """
+        n_models = self.matrix.getnnz(axis=0)
+        return pd.DataFrame({
+            "n_elements": np.asarray(self.matrix.sum(axis=0)).ravel(),
+            "n_models": n_models,
+            "model_share": n_models / self.n_models if self.n_models else np.nan
+        }, index=self.categories).sort_values("n_elements", ascending=False)
+
+    def _get_columns(self, categories: Optional[List[str]]) -> Tuple[sparse.csc_matrix, pd.Index]:
+        matrix = self.matrix.tocsc()
+        if categories is None:
+            return matrix, self.categories
+        columns = self.categories.get_indexer(categories)
+        if (columns < 0).any():
+            raise KeyError(f"Unknown categories: {list(pd.Index(categories)[columns < 0])}")
+        return matrix[:, columns], pd.Index(categories, name="category")
+
+    def correlation(self, categories: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Returns the Pearson correlation of the counts of the categories (all categories or the given ones) over
+        the models, like df_cnts.corr(). Only the category x category Gram matrix is dense.
+        """
+        matrix, categories = self._get_columns(categories)
+        # summed in float64, the squared counts overflow the int32 counts of large corpora
+        matrix = matrix.astype(np.float64)
+        n = self.n_models
+        sums = np.asarray(matrix.sum(axis=0)).ravel()
+        gram = (matrix.T @ matrix).toarray()
+        covariance = (gram - np.outer(sums, sums) / n) / (n - 1)
+        std = np.sqrt(np.diag(covariance))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # categories with constant counts have no defined correlation (NaN, like pandas)
+            correlation = covariance / np.outer(std, std)
+        return pd.DataFrame(correlation, index=categories, columns=categories)
+
+    def cooccurrence(self, categories: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Returns the number of models that contain both categories for each pair of categories (all categories or
+        the given ones), the diagonal is the number of models that contain the category.
+        """
+        matrix, categories = self._get_columns(categories)
+        occurs = (matrix > 0).astype(np.int64)
+        return pd.DataFrame((occurs.T @ occurs).toarray(), index=categories, columns=categories)
+
+def build_category_counts(csv_paths=None, namespace=None, batch_size=None, use_cache=True) -> CategoryCounts:
+    """
+    Builds the counts batch by batch from BpmnModelParser(namespace=namespace).iter_model_elements (by default of
+    all namespaces), only the sparse counts of the batches are kept in memory.
+    """
+    bpmn_parser = BpmnModelParser(namespace=namespace)
+    counts = [CategoryCounts.from_elements(df) for df in
+              bpmn_parser.iter_model_elements(csv_paths, batch_size=batch_size, use_cache=use_cache)]
+    counts = CategoryCounts.concat(counts)
+    _logger.info("Counted %d categories in %d models (%d non-zero counts)", len(counts.categories), counts.n_models,
+                 counts.matrix.nnz)
+    return counts
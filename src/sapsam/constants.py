@@ -6,6 +6,8 @@ DATA_RAW = DATA_ROOT / "raw"
 DATA_CONVENTIONS = DATA_RAW / "sap_sam_2022" / "conventions"
 DATA_DATASET = DATA_RAW / "sap_sam_2022" / "models"
 DATA_INTERIM = DATA_ROOT / "interim"
+DATA_CACHE = DATA_INTERIM / "cache"
+DATA_MODEL_STORE = DATA_INTERIM / "model_store"
 SRC_ROOT = PROJECT_ROOT / "src" / "sapsam"
 FIGURES_ROOT = PROJECT_ROOT / "reports" / "figures"
 
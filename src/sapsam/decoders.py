@@ -0,0 +1,43 @@
+import json
+from typing import Callable, Dict, Union
+
+# optional, faster JSON parsers, the stdlib json module is used if none of them is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+JSON_BACKENDS = ["auto", "json", "orjson", "simdjson"]
+
+def _orjson_loads(s: Union[str, bytes]):
+    try:
+        return orjson.loads(s)
+    except orjson.JSONDecodeError:
+        # orjson is stricter than json, e.g. it rejects NaN and integers beyond 64 bit
+        return json.loads(s)
+
+def get_json_loads(backend="auto") -> Callable[[Union[str, bytes]], Dict]:
+    """
+    Returns a function that decodes a JSON document.
+        - "json": stdlib json module
+        - "orjson" / "simdjson": orjson or pysimdjson
+        - "auto": orjson if installed, else simdjson, else json
+    """
+    if backend not in JSON_BACKENDS:
+        raise ValueError(f"Unknown JSON backend: {backend}, available backends: {JSON_BACKENDS}")
+    if backend == "auto":
+        backend = "orjson" if orjson is not None else "simdjson" if simdjson is not None else "json"
+    if backend == "json":
+        return json.loads
+    if backend == "orjson":
+        if orjson is None:
+            raise ImportError("JSON backend 'orjson' requires the orjson package")
+        return _orjson_loads
+    if simdjson is None:
+        raise ImportError("JSON backend 'simdjson' requires the pysimdjson package")
+    return simdjson.loads
@@ -1,19 +1,49 @@
+from typing import Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
 import spacy
+from langdetect.detector import Detector
+from langdetect.detector_factory import DetectorFactory, PROFILES_DIRECTORY
+from langdetect.utils.ngram import NGram
 from spacy.language import Language
 from spacy_langdetect import LanguageDetector
 from tqdm import tqdm
 
+from sapsam.parser import BpmnModelParser
+
 
 def get_df_models_and_labels(df, sep_str=" "):
-    df_labels = df.drop(columns="category", axis=1)
-    df_labels.reset_index(inplace=True)
-    df_labels.drop(columns="glossary_link_id", axis=1, inplace=True)
-    df_labels.drop(columns="element_id", axis=1, inplace=True)
-    df_labels.label = df_labels.label.apply(lambda x: str(x or ''))
-    df_labels.drop_duplicates(ignore_index=True, inplace=True)
-    df_labels['label'] = df_labels.groupby(['model_id'])['label'].transform(lambda x: sep_str.join(x))
-    df_labels.drop_duplicates(ignore_index=True, inplace=True)
-    return df_labels.set_index("model_id")
+    """
+    Aggregates the model elements into one row per model and name with the distinct element labels of the model
+    joined by sep_str (in order of their first occurrence, missing labels count as empty label). A model id that
+    occurs with several names (e.g. duplicated models of different csvs) has one row per name, each with the
+    labels of all its elements.
+    """
+    df_labels = pd.DataFrame({
+        "model_id": df.index.get_level_values("model_id"),
+        "name": df["name"].to_numpy(),
+        "label": df["label"].fillna("").astype(str).to_numpy()
+    })
+    # deduplicate the (model, name, label) rows before joining, so that every label is joined once per model name
+    df_labels = df_labels[~df_labels.duplicated()]
+    labels = df_labels.groupby("model_id", sort=False)["label"].agg(sep_str.join)
+    df_names = df_labels.loc[~df_labels.duplicated(["model_id", "name"]), ["model_id", "name"]]
+    return pd.DataFrame({"label": labels.reindex(df_names["model_id"]).to_numpy(), "name": df_names["name"].to_numpy()},
+                        index=pd.Index(df_names["model_id"], name="model_id"))
+
+
+def iter_df_models_and_labels(bpmn_parser=None, csv_paths=None, sep_str=" ", batch_size=None,
+                              use_cache=True) -> Iterator[pd.DataFrame]:
+    """
+    Yields get_df_models_and_labels csv by csv (or batch by batch with batch_size, see
+    BpmnModelParser.iter_model_elements), so the element frame of the whole dataset is never held in memory.
+    Models never span several csvs or batches, so the yielded frames can simply be concatenated.
+    """
+    if bpmn_parser is None:
+        bpmn_parser = BpmnModelParser()
+    for df in bpmn_parser.iter_model_elements(csv_paths, batch_size=batch_size, use_cache=use_cache):
+        yield get_df_models_and_labels(df, sep_str)
 
 
 def clean(label):
@@ -28,22 +58,170 @@ def get_lang_detector(nlp, name):
     return LanguageDetector()
 
 
+# registered on import (instead of in ModelLanguageDetector) so that nlp.pipe worker processes know the components
+Language.factory("language_detector", func=get_lang_detector)
+
+
+@Language.component("language_result")
+def store_language_result(doc):
+    # the language detector only registers a lazy getter, storing its result in the doc's user data makes the
+    # detection run inside the nlp.pipe worker processes, user data is sent back to the main process with the doc
+    doc.user_data["language"] = doc._.language
+    return doc
+
+
+class SpacyLanguageEngine:
+    """
+    Detects languages with spacy_langdetect in an en_core_web_sm pipeline, texts are processed in batches of
+    batch_size with nlp.pipe, using n_process processes.
+    """
+    def __init__(self, batch_size=1000, n_process=1):
+        self.batch_size = batch_size
+        self.n_process = n_process
+        # only the language detector output is used, so the trained pipeline components are not loaded,
+        # the language detector just needs sentence boundaries, which the rule-based sentencizer provides
+        self.nlp = spacy.load("en_core_web_sm", exclude=["tok2vec", "tagger", "parser", "senter", "attribute_ruler",
+                                                         "lemmatizer", "ner"])
+        self.nlp.add_pipe('sentencizer')
+        self.nlp.add_pipe('language_detector', last=True)
+        self.nlp.add_pipe('language_result', last=True)
+
+    def detect(self, texts: List[str]) -> List[Tuple[str, float]]:
+        docs = self.nlp.pipe(texts, batch_size=self.batch_size, n_process=self.n_process)
+        results = [doc.user_data["language"] for doc in tqdm(docs, total=len(texts))]
+        return [(result["language"], result["score"]) for result in results]
+
+
+class NgramLanguageEngine:
+    """
+    Fully offline character n-gram (1 to 3) naive Bayes classifier over the language profiles that ship with
+    langdetect (the detector behind spacy_langdetect). Unlike langdetect, which samples n-grams at random in
+    several trials, all n-grams of a text are scored at once against a log probability matrix, which makes the
+    detection deterministic and much faster. languages restricts the candidate languages (ISO codes).
+    """
+    def __init__(self, languages=None):
+        factory = DetectorFactory()
+        factory.load_profile(PROFILES_DIRECTORY)
+        lang_idx = [i for i, lang in enumerate(factory.langlist) if languages is None or lang in languages]
+        self.languages = [factory.langlist[i] for i in lang_idx]
+        self.ngram_idx = {ngram: i for i, ngram in enumerate(factory.word_lang_prob_map)}
+        # smoothing as in langdetect's probability update with the default alpha
+        probs = np.array(list(factory.word_lang_prob_map.values()))[:, lang_idx]
+        self.log_probs = np.log(probs + Detector.ALPHA_DEFAULT / Detector.BASE_FREQ)
+
+    def _get_ngram_rows(self, text: str) -> List[int]:
+        rows = []
+        ngram = NGram()
+        for ch in text:
+            ngram.add_char(ch)
+            if ngram.capitalword:
+                continue
+            for n in range(1, NGram.N_GRAM + 1):
+                if len(ngram.grams) < n:
+                    break
+                row = self.ngram_idx.get(ngram.grams[-n:])
+                if row is not None and ngram.grams[-n:] != ' ':
+                    rows.append(row)
+        return rows
+
+    def detect(self, texts: List[str]) -> List[Tuple[str, float]]:
+        results = []
+        for text in tqdm(texts):
+            rows = self._get_ngram_rows(text)
+            if not rows:
+                results.append(("UNKNOWN", 0.0))
+                continue
+            log_posterior = self.log_probs[rows].sum(axis=0)
+            posterior = np.exp(log_posterior - log_posterior.max())
+            best = posterior.argmax()
+            results.append((self.languages[best], float(posterior[best] / posterior.sum())))
+        return results
+
+
+class FastTextLanguageEngine:
+    """
+    Detects languages with a fastText language identification model (e.g. lid.176.ftz), requires the optional
+    fasttext package and a local model file.
+    """
+    def __init__(self, model_path):
+        try:
+            import fasttext
+        except ImportError as e:
+            raise ImportError("The fasttext language engine requires the fasttext package") from e
+        self.model = fasttext.load_model(str(model_path))
+
+    def detect(self, texts: List[str]) -> List[Tuple[str, float]]:
+        results = [("UNKNOWN", 0.0)] * len(texts)
+        idx = [i for i, text in enumerate(texts) if text]
+        labels, probs = self.model.predict([texts[i] for i in idx], k=1)
+        for i, label, prob in zip(idx, labels, probs):
+            results[i] = (label[0].replace("__label__", ""), float(prob[0]))
+        return results
+
+
+LANGUAGE_ENGINES = {
+    'spacy': SpacyLanguageEngine,
+    'ngram': NgramLanguageEngine,
+    'fasttext': FastTextLanguageEngine
+}
+
+
 class ModelLanguageDetector:
-    def __init__(self, threshold):
+    def __init__(self, threshold, engine="spacy", **engine_kwargs):
+        """
+        engine is one of LANGUAGE_ENGINES ("spacy", "ngram" or "fasttext"), created with engine_kwargs,
+        or an engine instance. Detections with a score below threshold are reported as "UNKNOWN".
+        """
         self.threshold = threshold
-        self.nlp = spacy.load("en_core_web_sm")
-        Language.factory("language_detector", func=get_lang_detector)
-        self.nlp.add_pipe('language_detector', last=True)
+        if isinstance(engine, str):
+            if engine not in LANGUAGE_ENGINES:
+                raise ValueError(f"Unknown language engine: {engine}, available engines: {list(LANGUAGE_ENGINES)}")
+            engine = LANGUAGE_ENGINES[engine](**engine_kwargs)
+        self.engine = engine
+        # detected (language, score) by cleaned text, process names and labels repeat a lot across models
+        self._languages = {}
+
+    def detect_languages(self, texts) -> List[str]:
+        """
+        Returns the detected language of every text. Each distinct text is only detected once.
+        """
+        cleaned_texts = [clean(str(text)) for text in texts]
+        new_texts = [text for text in dict.fromkeys(cleaned_texts) if text not in self._languages]
+        self._languages.update(zip(new_texts, self.engine.detect(new_texts)))
+        return [self._apply_threshold(*self._languages[text]) for text in cleaned_texts]
+
+    def _apply_threshold(self, language, score):
+        return language if score >= self.threshold else "UNKNOWN"
 
     def _get_text_language(self, text):
-        doc = self.nlp(str(clean(text)))
-        detection = doc._.language
-        return detection['language']
+        return self.detect_languages([text])[0]
 
     def add_detected_natural_language_from_meta(self, df_meta):
-        df_meta['detected_natural_language'] = [self._get_text_language(name) for name in tqdm(df_meta.name)]
+        df_meta['detected_natural_language'] = self.detect_languages(df_meta.name)
 
     def get_detected_natural_language_from_bpmn_model(self, df):
         df_labels = get_df_models_and_labels(df, " ")
-        df_labels['detected_natural_language'] = [self._get_text_language(label) for label in tqdm(df_labels.label)]
+        df_labels['detected_natural_language'] = self.detect_languages(df_labels.label)
         return df_labels
+
+    def get_detected_natural_language_from_csvs(self, csv_paths=None, bpmn_parser=None, batch_size=None):
+        """
+        Same as get_detected_natural_language_from_bpmn_model, but parses the model elements csv by csv
+        (see iter_df_models_and_labels) instead of taking the element frame of all models.
+        """
+        df_labels = pd.concat(iter_df_models_and_labels(bpmn_parser, csv_paths, " ", batch_size))
+        df_labels['detected_natural_language'] = self.detect_languages(df_labels.label)
+        return df_labels
+
+
+def get_engine_agreement(texts, detector, reference_detector) -> pd.DataFrame:
+    """
+    Detects the languages of texts with two ModelLanguageDetectors and returns one row per text with both
+    languages, e.g. the agreement rate is df.agree.mean() and pd.crosstab(df.reference, df.language) shows
+    where the detectors disagree.
+    """
+    df = pd.DataFrame({"text": list(texts)})
+    df["language"] = detector.detect_languages(df.text)
+    df["reference"] = reference_detector.detect_languages(df.text)
+    df["agree"] = df.language == df.reference
+    return df
@@ -1,37 +1,36 @@
 import json
+from typing import Callable, List
+
 import pandas as pd
 
+from sapsam import parser
+from sapsam.constants import SRC_ROOT
 
-def filter_example_processes(dataset):
-    with open("../src/sapsam/prefilled_example_processes.json") as data_file:    
+
+def get_example_names():
+    with open(SRC_ROOT / "prefilled_example_processes.json") as data_file:
         examples = json.load(data_file)
 
     example_names = []
     for batch in examples["example_processes"]:
         example_names.extend(batch["content"])
-    example_names = set(example_names)
+    return set(example_names)
+
+def filter_example_processes(dataset):
+    example_names = get_example_names()
     dataset = dataset[~dataset["name"].isin(example_names)]
     return dataset
 
 def filter_example_processes_bpmn(dataset):
-    with open("../src/sapsam/prefilled_example_processes.json") as data_file:
-        examples = json.load(data_file)
-
     dataset_size = len(dataset.index.get_level_values('model_id').unique())
-    example_names = []
-    for batch in examples["example_processes"]:
-        example_names.extend(batch["content"])
-    example_names = set(example_names)
+    example_names = get_example_names()
 
     print('Filtering out example processes models...')
-    dataset.reset_index(inplace=True)
-    valid_models = []
-    for model_id, group in dataset.groupby('model_id'):
-        if not group['name'].isin(example_names).all():
-           valid_models.append(model_id)
-    
+    # a model is an example process if all of its rows carry an example name, computed in a single groupby
+    is_example = dataset['name'].isin(example_names).groupby(level='model_id').all()
+    valid_models = is_example.index[~is_example.to_numpy()]
+
     print(f'Keeping {len(valid_models)} out of {dataset_size} from the dataset')
-    dataset.set_index(['model_id', 'element_id'], inplace=True)
     dataset = dataset.loc[valid_models]
     index = dataset.index.get_level_values('model_id')
     print(f'Dataset has been filtered down to {index.nunique()} models, \
@@ -100,17 +99,16 @@ def filter_models(dataset, value=None):
     dataset = dataset.loc[valid_models]
 
     print('Filtering out models with no start, end, or task elements...')
-    dataset.reset_index(inplace=True)
-    valid_models_too = []
-    for model_id, group in dataset.groupby('model_id'):
-        if (any(group['category'].eq(category).any() for category in valid_start_elements) and
-            any(group['category'].eq(category).any() for category in valid_task_elements) and
-            any(group['category'].eq(category).any() for category in valid_end_elements)):
-            valid_models_too.append(model_id)
-        # else:
-        #     print(model_id)
+    # per-model has-start/has-task/has-end flags in a single groupby instead of one loop iteration per model
+    category = dataset['category']
+    element_flags = pd.DataFrame({
+        'start': category.isin(valid_start_elements),
+        'task': category.isin(valid_task_elements),
+        'end': category.isin(valid_end_elements)
+    }, index=dataset.index)
+    model_flags = element_flags.groupby(level='model_id').any()
+    valid_models_too = model_flags.index[model_flags.all(axis=1).to_numpy()]
     print(f'Keeping {len(valid_models_too)} out of {len(valid_models)} from the dataset\n')
-    dataset.set_index(['model_id', 'element_id'], inplace=True)
     dataset = dataset.loc[valid_models_too]
     index = dataset.index.get_level_values('model_id')
     print(f'Dataset has been filtered down to {index.nunique()} models, \
@@ -124,6 +122,90 @@ filters = {
     'models': filter_models
 }
 
+def get_notations():
+    with open(SRC_ROOT / "mappings.json") as data_file:
+        return json.load(data_file)["namespaces"]
+
+class FilterPipeline:
+    '''
+    Lazily chains filters, nothing is parsed or filtered before collect() is called.
+    Filters that only need model metadata (example processes, namespaces, metadata predicates) always run first,
+    on the metadata, and only the BPMN models that pass them are parsed into elements for the element filters
+    (models, element predicates). The Model JSON of dropped models is never decoded.
+    ex: df = DataFilter(df_meta).pipeline().example_processes().models(5).collect()
+    '''
+    def __init__(self, df_meta=None):
+        self.df_meta = df_meta
+        self._metadata_steps = []
+        self._element_steps = []
+
+    def example_processes(self):
+        self._metadata_steps.append(("example_processes", filter_example_processes))
+        return self
+
+    def namespaces(self, value):
+        '''
+        Keeps the models of the given namespace(s), given as namespace URL or notation (see mappings.json).
+        '''
+        values = {value} if isinstance(value, str) else set(value)
+        notations = get_notations()
+        namespaces = {namespace for namespace, notation in notations.items() if notation in values} | values
+
+        def filter_model_namespaces(df_meta):
+            return df_meta[df_meta["namespace"].isin(namespaces)]
+
+        self._metadata_steps.append((f"namespaces {sorted(values)}", filter_model_namespaces))
+        return self
+
+    def models(self, value):
+        self._element_steps.append((f"models {value}", lambda df: filter_models(df, value)))
+        return self
+
+    def where(self, predicate: Callable[[pd.DataFrame], pd.Series], level="metadata"):
+        '''
+        Adds a custom filter, predicate receives the metadata (level="metadata") or the BPMN elements
+        (level="elements") and returns a boolean mask of the rows to keep.
+        '''
+        if level not in ("metadata", "elements"):
+            raise ValueError(f"Filter error: unknown level {level}, expected 'metadata' or 'elements'")
+        steps = self._metadata_steps if level == "metadata" else self._element_steps
+        steps.append((f"where ({level})", lambda df: df[predicate(df)]))
+        return self
+
+    def explain(self) -> List[str]:
+        '''
+        Returns the filters in the order in which collect() runs them.
+        '''
+        plan = ["parse metadata"] if self.df_meta is None else []
+        plan += [name for name, _ in self._metadata_steps]
+        if self._element_steps:
+            plan.append("parse elements of remaining BPMN models")
+            plan += [name for name, _ in self._element_steps]
+        return plan
+
+    def collect(self, csv_paths=None, elements=None, bpmn_parser=None, n_workers=1) -> pd.DataFrame:
+        '''
+        Runs the pipeline and returns the filtered metadata, or the filtered BPMN elements if there are element
+        filters or elements=True. bpmn_parser (default: parser.BpmnModelParser()) parses the elements.
+        '''
+        df_meta = self.df_meta
+        if df_meta is None:
+            df_meta = parser.parse_model_metadata(csv_paths, n_workers=n_workers)
+        for _, step in self._metadata_steps:
+            df_meta = step(df_meta)
+
+        if elements is None:
+            elements = len(self._element_steps) > 0
+        if not elements:
+            return df_meta
+
+        if bpmn_parser is None:
+            bpmn_parser = parser.BpmnModelParser()
+        df = bpmn_parser.parse_model_elements(csv_paths, n_workers=n_workers, model_ids=set(df_meta.index))
+        for _, step in self._element_steps:
+            df = step(df)
+        return df
+
 class DataFilter:
     '''
     Considering using static method to remove the need of class instantiation.
@@ -131,6 +213,13 @@ class DataFilter:
     '''
     def __init__(self, dataset):
         self.dataset = dataset
+
+    def pipeline(self) -> FilterPipeline:
+        '''
+        Returns a lazy FilterPipeline over the dataset, which has to be model metadata
+        (e.g. from parser.parse_model_metadata) or None to parse the metadata on collect().
+        '''
+        return FilterPipeline(self.dataset)
     
     def filter_data(self, filter_key: str, value=None, threshold=None):
         if filter_key in filters:
@@ -0,0 +1,148 @@
+import logging
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csgraph
+
+from sapsam.model_graphs import ModelGraphs, _build_csv_graphs
+from sapsam.parser import get_csv_paths, map_csvs
+from sapsam.syntax import ACTIVITY_STENCILS, GATEWAY_STENCILS, _is_end_event, _is_intermediate_event, \
+    _is_start_event
+
+_logger = logging.getLogger(__name__)
+
+# gateway types whose splits and joins are matched by the connector mismatch
+CONNECTOR_TYPES = {
+    "xor": {"Exclusive_Databased_Gateway", "EventbasedGateway"},
+    "and": {"ParallelGateway"},
+    "or": {"InclusiveGateway"},
+    "complex": {"ComplexGateway"}
+}
+
+def _get_category_mask(graphs: ModelGraphs, is_category) -> np.ndarray:
+    # classifies the categories once and maps the result to the nodes, -1 (no category) is never matched
+    mask = np.array([bool(is_category(category)) for category in graphs.categories] + [False])
+    return mask[graphs.category_codes]
+
+def get_control_flow(graphs: ModelGraphs, is_flow_node: np.ndarray) -> ModelGraphs:
+    """
+    Returns the control flow graph on the same nodes: an arc connects two flow nodes if a sequence flow leads
+    from one to the other, or if the second is an event attached to the first (boundary event). The sequence
+    flow elements themselves have no arcs.
+    """
+    sources = np.repeat(np.arange(graphs.n_nodes), graphs.out_degree())
+    targets = np.asarray(graphs.indices)
+    is_sequence_flow = _get_category_mask(graphs, lambda category: category == "SequenceFlow")
+    into_flow = is_flow_node[sources] & is_sequence_flow[targets]
+    out_of_flow = is_sequence_flow[sources] & is_flow_node[targets]
+    arcs = pd.merge(pd.DataFrame({"flow": targets[into_flow], "source": sources[into_flow]}),
+                    pd.DataFrame({"flow": sources[out_of_flow], "target": targets[out_of_flow]}), on="flow")
+    attached = is_flow_node[sources] & is_flow_node[targets]
+    arc_sources = np.concatenate([arcs["source"].to_numpy(), sources[attached]])
+    arc_targets = np.concatenate([arcs["target"].to_numpy(), targets[attached]])
+    order = np.argsort(arc_sources, kind="stable")
+    indptr = np.r_[0, np.cumsum(np.bincount(arc_sources, minlength=graphs.n_nodes))].astype(np.int64)
+    return ModelGraphs(graphs.model_ids, graphs.element_ids, graphs.categories, graphs.category_codes,
+                       graphs.node_offsets, graphs.parent, indptr, arc_targets[order].astype(np.int32))
+
+def get_nesting_depth(graphs: ModelGraphs) -> np.ndarray:
+    """
+    Returns the length of the parent chain of every node (0 for top level elements), all chains are followed
+    at once, one step per level.
+    """
+    parent = np.asarray(graphs.parent)
+    depth = np.zeros(graphs.n_nodes, dtype=np.int32)
+    current = parent.copy()
+    active = np.flatnonzero(current >= 0)
+    while len(active) > 0:
+        depth[active] += 1
+        current[active] = parent[current[active]]
+        active = active[current[active] >= 0]
+    return depth
+
+def _ratio(numerator, denominator) -> np.ndarray:
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(denominator > 0, numerator / np.maximum(denominator, 1), np.nan)
+
+def compute_metrics(graphs: ModelGraphs) -> pd.DataFrame:
+    """
+    Computes the structural metrics of every model of graphs and returns them indexed by model_id. Flow nodes are
+    activities, events and gateways, arcs are the control flow arcs between them (see get_control_flow).
+        - n_elements, n_nodes, n_arcs, n_activities, n_events, n_gateways, n_start_events, n_end_events: sizes
+        - density: n_arcs / (n_nodes * (n_nodes - 1))
+        - connector_mismatch: sum over the gateway types of |outgoing arcs of splits - incoming arcs of joins|
+        - nesting_depth: longest parent chain (pools, lanes, subprocesses) of an element
+        - sequentiality: share of arcs that connect two non-gateway nodes
+        - cyclicity: share of flow nodes on a cycle
+        - start_reachability: share of flow nodes that are reachable from a start event
+        - end_reachability: share of flow nodes from which an end event is reachable
+        - n_components: number of weakly connected components of the flow nodes
+    Ratios of models without flow nodes (or arcs) are NaN.
+    """
+    is_start = _get_category_mask(graphs, _is_start_event)
+    is_end = _get_category_mask(graphs, _is_end_event)
+    is_event = is_start | is_end | _get_category_mask(graphs, _is_intermediate_event)
+    is_activity = _get_category_mask(graphs, lambda category: category in ACTIVITY_STENCILS)
+    is_gateway = _get_category_mask(graphs, lambda category: category in GATEWAY_STENCILS)
+    is_flow_node = is_activity | is_event | is_gateway
+    flow = get_control_flow(graphs, is_flow_node)
+    n_nodes = graphs.sum_per_model(is_flow_node)
+    n_arcs = flow.sum_per_model(flow.out_degree())
+    out_degree, in_degree = flow.out_degree(), flow.in_degree()
+
+    mismatch = np.zeros(graphs.n_models)
+    for categories in CONNECTOR_TYPES.values():
+        is_connector = _get_category_mask(graphs, lambda category: category in categories)
+        split_arcs = flow.sum_per_model(np.where(is_connector & (out_degree > 1), out_degree, 0))
+        join_arcs = flow.sum_per_model(np.where(is_connector & (in_degree > 1), in_degree, 0))
+        mismatch += np.abs(split_arcs - join_arcs)
+
+    arc_sources = np.repeat(np.arange(flow.n_nodes), out_degree)
+    is_sequential = ~is_gateway[arc_sources] & ~is_gateway[np.asarray(flow.indices)]
+    n_sequential = flow.sum_per_model(np.bincount(arc_sources[is_sequential], minlength=flow.n_nodes))
+
+    labels, _ = flow.connected_components("strong")
+    has_self_loop = np.bincount(arc_sources[arc_sources == np.asarray(flow.indices)], minlength=flow.n_nodes) > 0
+    on_cycle = is_flow_node & ((np.bincount(labels)[labels] > 1) | has_self_loop)
+    _, n_components = flow.connected_components("weak")
+    # nodes that are not flow nodes are isolated in the control flow graph, each is its own component
+    n_components = n_components - graphs.sum_per_model(~is_flow_node)
+
+    depth = get_nesting_depth(graphs)
+    return pd.DataFrame({
+        "n_elements": np.diff(graphs.node_offsets),
+        "n_nodes": n_nodes.astype(np.int64),
+        "n_arcs": n_arcs.astype(np.int64),
+        "n_activities": graphs.sum_per_model(is_activity).astype(np.int64),
+        "n_events": graphs.sum_per_model(is_event).astype(np.int64),
+        "n_gateways": graphs.sum_per_model(is_gateway).astype(np.int64),
+        "n_start_events": graphs.sum_per_model(is_start).astype(np.int64),
+        "n_end_events": graphs.sum_per_model(is_end).astype(np.int64),
+        "density": _ratio(n_arcs, n_nodes * (n_nodes - 1)),
+        "connector_mismatch": mismatch.astype(np.int64),
+        # models consist of at least one element, so reduceat never sees an empty range
+        "nesting_depth": np.maximum.reduceat(depth, graphs.node_offsets[:-1]) if graphs.n_models else depth,
+        "sequentiality": _ratio(n_sequential, n_arcs),
+        "cyclicity": _ratio(graphs.sum_per_model(on_cycle), n_nodes),
+        "start_reachability": _ratio(graphs.sum_per_model(flow.reachable(is_start) & is_flow_node), n_nodes),
+        "end_reachability": _ratio(graphs.sum_per_model(flow.reachable(is_end, reverse=True) & is_flow_node),
+                                   n_nodes),
+        "n_components": n_components.astype(np.int64)
+    }, index=pd.Index(graphs.model_ids, name="model_id"))
+
+def _compute_metrics_csv(csv_path: Path, use_cache=True) -> pd.DataFrame:
+    return compute_metrics(_build_csv_graphs(csv_path, use_cache))
+
+def compute_metrics_csvs(csv_paths=None, n_workers=1, use_cache=True) -> pd.DataFrame:
+    """
+    Computes the metrics of the BPMN models of the csvs (see compute_metrics), csv by csv and in parallel with
+    n_workers (see parser.map_csvs), so that only the graphs of one csv per worker are in memory. Models without
+    elements are not included.
+    """
+    if csv_paths is None:
+        csv_paths = get_csv_paths()
+    df = pd.concat(map_csvs(partial(_compute_metrics_csv, use_cache=use_cache), csv_paths, n_workers))
+    _logger.info("Computed the metrics of %d models", len(df))
+    return df
@@ -0,0 +1,259 @@
+import logging
+from functools import partial
+from itertools import chain
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse import csgraph
+
+from sapsam.constants import DATA_INTERIM
+from sapsam.parser import BpmnModelParser, get_csv_paths, map_csvs
+
+_logger = logging.getLogger(__name__)
+
+DATA_MODEL_GRAPHS = DATA_INTERIM / "model_graphs"
+
+# integer arrays that are saved as .npy files and memory mapped by ModelGraphs.load
+_ARRAYS = ["node_offsets", "category_codes", "parent", "indptr", "indices"]
+
+_graph_parser = BpmnModelParser(parse_outgoing=True, parse_parent=True)
+
+def _gather_neighbors(indptr: np.ndarray, indices: np.ndarray, nodes: np.ndarray) -> np.ndarray:
+    # concatenates indices[indptr[v]:indptr[v + 1]] for all nodes without a Python loop
+    starts = indptr[nodes]
+    counts = indptr[nodes + 1] - starts
+    total = int(counts.sum())
+    if total == 0:
+        return np.array([], dtype=indices.dtype)
+    shifts = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+    return indices[shifts + np.arange(total)]
+
+class ModelGraphs:
+    """
+    The elements of many BPMN models as one integer coded graph, e.g.
+        graphs = build_model_graphs()
+        n_components = graphs.connected_components()[1]
+    Node v is an element (in the order of BpmnModelParser), the nodes of model m are
+    node_offsets[m]:node_offsets[m + 1]. The edges are the outgoing references of the Model JSON, i.e. a task
+    points to its outgoing sequence flow, which points to its target. They are stored as CSR arrays over all
+    nodes: the targets of v are indices[indptr[v]:indptr[v + 1]]. parent[v] is the node that contains v (pool,
+    lane, subprocess) or -1 for top level elements. Edges and parents never cross models. Models are the runs of
+    consecutive rows with the same model id, so a duplicated model id results in separate models.
+    """
+
+    def __init__(self, model_ids: np.ndarray, element_ids: np.ndarray, categories: List[str],
+                 category_codes: np.ndarray, node_offsets: np.ndarray, parent: np.ndarray, indptr: np.ndarray,
+                 indices: np.ndarray):
+        self.model_ids = model_ids
+        self.element_ids = element_ids
+        self.categories = categories
+        self.category_codes = category_codes
+        self.node_offsets = node_offsets
+        self.parent = parent
+        self.indptr = indptr
+        self.indices = indices
+        self._model_of_node = None
+        self._reverse = None
+
+    @classmethod
+    def from_elements(cls, df: pd.DataFrame) -> "ModelGraphs":
+        """
+        Builds the graphs from elements parsed with BpmnModelParser(parse_outgoing=True, parse_parent=True).
+        References to elements that do not exist in the model are dropped.
+        """
+        model_ids = df.index.get_level_values("model_id").to_numpy()
+        element_ids = df.index.get_level_values("element_id").to_numpy()
+        n_nodes = len(df)
+        starts = np.flatnonzero(np.r_[True, model_ids[1:] != model_ids[:-1]]) if n_nodes else np.array([], int)
+        node_offsets = np.append(starts, n_nodes).astype(np.int64)
+        node_model = np.repeat(np.arange(len(starts)), np.diff(node_offsets))
+
+        # (model, element id) -> node, the element ids and references are factorized together and combined with
+        # the model number into int64 keys, the first element wins if an element id is duplicated within a model
+        parents = df["parent"].to_numpy()
+        outgoing = df["outgoing"].tolist()
+        counts = np.fromiter(map(len, outgoing), dtype=np.int64, count=n_nodes)
+        targets = np.array(list(chain.from_iterable(outgoing)), dtype=object)
+        codes, uniques = pd.factorize(np.concatenate([element_ids, parents, targets]))
+        element_codes, parent_codes, target_codes = np.split(codes, [n_nodes, 2 * n_nodes])
+        keys = pd.Index(node_model * len(uniques) + element_codes)
+        unique = ~keys.duplicated()
+        keys, key_nodes = keys[unique], np.flatnonzero(unique)
+
+        def resolve(models, ids) -> np.ndarray:
+            positions = keys.get_indexer(models * len(uniques) + ids)
+            # missing references (code -1) must not match the key of another element
+            return np.where((positions >= 0) & (ids >= 0), key_nodes[positions], -1)
+
+        parent = resolve(node_model, parent_codes).astype(np.int32)
+        sources = np.repeat(np.arange(n_nodes), counts)
+        targets = resolve(node_model[sources], target_codes)
+        resolved = targets >= 0
+        if not resolved.all():
+            _logger.info("Dropped %d references to missing elements", (~resolved).sum())
+        indptr = np.r_[0, np.cumsum(np.bincount(sources[resolved], minlength=n_nodes))].astype(np.int64)
+        category = pd.Categorical(df["category"])
+        return cls(
+            model_ids=model_ids[starts], element_ids=element_ids, categories=list(category.categories),
+            category_codes=category.codes.astype(np.int32), node_offsets=node_offsets, parent=parent,
+            indptr=indptr, indices=targets[resolved].astype(np.int32))
+
+    @classmethod
+    def concat(cls, graphs: List["ModelGraphs"]) -> "ModelGraphs":
+        """
+        Concatenates the graphs (e.g. of several csvs), node and model numbers are shifted accordingly.
+        """
+        categories = sorted(set(chain.from_iterable(g.categories for g in graphs)))
+        node_shifts = np.cumsum([0] + [g.n_nodes for g in graphs])
+        edge_shifts = np.cumsum([0] + [g.n_edges for g in graphs])
+        if node_shifts[-1] >= np.iinfo(np.int32).max:
+            raise ValueError(f"Too many nodes for int32 node numbers: {node_shifts[-1]}")
+        category_codes = []
+        for g in graphs:
+            # -1 (missing category) is mapped to -1 by the appended entry
+            mapping = np.append(pd.Index(categories).get_indexer(g.categories), -1).astype(np.int32)
+            category_codes.append(mapping[g.category_codes])
+        return cls(
+            model_ids=np.concatenate([g.model_ids for g in graphs]) if graphs else np.array([], dtype=object),
+            element_ids=np.concatenate([g.element_ids for g in graphs]) if graphs else np.array([], dtype=object),
+            categories=categories,
+            category_codes=np.concatenate(category_codes or [np.array([], dtype=np.int32)]),
+            node_offsets=np.r_[0, np.concatenate([g.node_offsets[1:] + s for g, s in zip(graphs, node_shifts)]
+                                                 or [np.array([], dtype=np.int64)])].astype(np.int64),
+            parent=np.concatenate([np.where(g.parent >= 0, g.parent + s, -1) for g, s in zip(graphs, node_shifts)]
+                                  or [np.array([], dtype=np.int32)]).astype(np.int32),
+            indptr=np.r_[0, np.concatenate([g.indptr[1:] + s for g, s in zip(graphs, edge_shifts)]
+                                           or [np.array([], dtype=np.int64)])].astype(np.int64),
+            indices=np.concatenate([g.indices + s for g, s in zip(graphs, node_shifts)]
+                                   or [np.array([], dtype=np.int32)]).astype(np.int32))
+
+    @property
+    def n_models(self) -> int:
+        return len(self.node_offsets) - 1
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.category_codes)
+
+    @property
+    def n_edges(self) -> int:
+        return len(self.indices)
+
+    def model_of_node(self) -> np.ndarray:
+        """
+        Returns the model number of every node.
+        """
+        if self._model_of_node is None:
+            self._model_of_node = np.repeat(np.arange(self.n_models), np.diff(self.node_offsets))
+        return self._model_of_node
+
+    def nodes_of_category(self, category: str) -> np.ndarray:
+        """
+        Returns a boolean mask of the nodes of the category (stencil id), e.g. "StartNoneEvent".
+        """
+        if category not in self.categories:
+            return np.zeros(self.n_nodes, dtype=bool)
+        return self.category_codes == self.categories.index(category)
+
+    def sum_per_model(self, values: np.ndarray) -> np.ndarray:
+        """
+        Sums the node values (e.g. a boolean mask) per model.
+        """
+        return np.bincount(self.model_of_node(), weights=values, minlength=self.n_models)
+
+    def out_degree(self) -> np.ndarray:
+        return np.diff(self.indptr)
+
+    def in_degree(self) -> np.ndarray:
+        return np.bincount(self.indices, minlength=self.n_nodes)
+
+    def get_csr_matrix(self) -> sparse.csr_matrix:
+        """
+        Returns the adjacency matrix of all nodes (block diagonal by model).
+        """
+        data = np.ones(self.n_edges, dtype=np.int8)
+        return sparse.csr_matrix((data, self.indices, self.indptr), shape=(self.n_nodes, self.n_nodes))
+
+    def _get_reverse_csr(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self._reverse is None:
+            sources = np.repeat(np.arange(self.n_nodes, dtype=np.int32), self.out_degree())
+            order = np.argsort(self.indices, kind="stable")
+            self._reverse = (np.r_[0, np.cumsum(self.in_degree())].astype(np.int64), sources[order])
+        return self._reverse
+
+    def reachable(self, sources: np.ndarray, reverse=False) -> np.ndarray:
+        """
+        Returns a boolean mask of the nodes that are reachable from the sources (node numbers or a boolean mask),
+        the sources included. With reverse, edges are followed backwards, i.e. the nodes from which a source is
+        reachable are returned. All models are traversed at once, breadth first, one frontier per step.
+        """
+        indptr, indices = self._get_reverse_csr() if reverse else (self.indptr, self.indices)
+        sources = np.asarray(sources)
+        frontier = np.flatnonzero(sources) if sources.dtype == bool else np.unique(sources)
+        visited = np.zeros(self.n_nodes, dtype=bool)
+        visited[frontier] = True
+        while len(frontier) > 0:
+            neighbors = _gather_neighbors(indptr, indices, frontier)
+            frontier = np.unique(neighbors[~visited[neighbors]])
+            visited[frontier] = True
+        return visited
+
+    def connected_components(self, connection="weak") -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the component label of every node and the number of components of every model, with connection
+        "weak" (edge directions ignored) or "strong" (see scipy.sparse.csgraph.connected_components).
+        """
+        _, labels = csgraph.connected_components(self.get_csr_matrix(), directed=connection == "strong",
+                                                 connection=connection)
+        _, first_nodes = np.unique(labels, return_index=True)
+        return labels, np.bincount(self.model_of_node()[first_nodes], minlength=self.n_models)
+
+    def save(self, path: Path = DATA_MODEL_GRAPHS):
+        """
+        Saves the integer arrays as .npy files (which load memory maps) and the ids and categories as parquet.
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for name in _ARRAYS:
+            np.save(path / f"{name}.npy", getattr(self, name))
+        pd.DataFrame({"model_id": self.model_ids}).to_parquet(path / "models.parquet")
+        pd.DataFrame({"element_id": self.element_ids}).to_parquet(path / "elements.parquet")
+        pd.DataFrame({"category": self.categories}).to_parquet(path / "categories.parquet")
+        _logger.info("Saved %d models with %d nodes and %d edges to %s", self.n_models, self.n_nodes,
+                     self.n_edges, path)
+
+    @classmethod
+    def load(cls, path: Path = DATA_MODEL_GRAPHS, mmap_mode: Optional[str] = "r") -> "ModelGraphs":
+        """
+        Loads graphs saved with save, the integer arrays are memory mapped with mmap_mode (None reads them).
+        """
+        path = Path(path)
+        arrays = {name: np.load(path / f"{name}.npy", mmap_mode=mmap_mode) for name in _ARRAYS}
+        return cls(
+            model_ids=pd.read_parquet(path / "models.parquet")["model_id"].to_numpy(),
+            element_ids=pd.read_parquet(path / "elements.parquet")["element_id"].to_numpy(),
+            categories=pd.read_parquet(path / "categories.parquet")["category"].tolist(),
+            **arrays)
+
+def _build_csv_graphs(csv_path: Path, use_cache=True) -> ModelGraphs:
+    if use_cache:
+        df = _graph_parser._load_bpmn_model_elements_csv(csv_path, columns=["category", "parent", "outgoing"])
+    else:
+        df = _graph_parser._parse_bpmn_model_elements_csv(csv_path)
+    return ModelGraphs.from_elements(df)
+
+def build_model_graphs(csv_paths=None, n_workers=1, use_cache=True) -> ModelGraphs:
+    """
+    Builds the graphs of the BPMN models of the csvs, csv by csv (in parallel with n_workers, see
+    parser.map_csvs). With use_cache, the elements are loaded from the parser's cache.
+    """
+    if csv_paths is None:
+        csv_paths = get_csv_paths()
+    graphs = ModelGraphs.concat(list(map_csvs(partial(_build_csv_graphs, use_cache=use_cache), csv_paths,
+                                              n_workers)))
+    _logger.info("Built the graphs of %d models with %d nodes and %d edges", graphs.n_models, graphs.n_nodes,
+                 graphs.n_edges)
+    return graphs
@@ -0,0 +1,219 @@
+import io
+import csv
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from sapsam import cache
+from sapsam.parser import get_csv_paths, parse_csv_raw
+
+_logger = logging.getLogger(__name__)
+
+# bytes of a csv that are scanned at once for record boundaries
+_SCAN_CHUNK_SIZE = 1 << 24
+
+# cache kind of the csv indexes, changed when their columns change so that old cache files are not read
+_INDEX_KIND = "model_index_v2"
+_DTYPES_KIND = "model_index_dtypes"
+
+def scan_record_offsets(csv_path: Path, chunk_size=_SCAN_CHUNK_SIZE) -> np.ndarray:
+    """
+    Returns the byte offsets at which the records of a csv start, followed by the offset of the end of the last
+    record, i.e. record i is the byte range offsets[i]:offsets[i + 1]. The header is not a record. A newline ends
+    a record if the number of quotes before it is even, newlines in quoted fields (such as the Model JSON) are
+    skipped this way. The csv is scanned chunk by chunk with numpy, the quote parity is carried across chunks.
+    """
+    offsets = []
+    parity = 0
+    position = 0
+    with open(csv_path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            buffer = np.frombuffer(chunk, dtype=np.uint8)
+            is_quote = buffer == ord('"')
+            # the uint8 cumsum wraps around at 256, which keeps the parity
+            quote_parity = (np.cumsum(is_quote, dtype=np.uint8) + parity) & 1
+            offsets.append(np.flatnonzero((buffer == ord("\n")) & (quote_parity == 0)) + position + 1)
+            parity = int(quote_parity[-1])
+            position += len(chunk)
+    offsets = np.concatenate(offsets) if offsets else np.array([], dtype=np.int64)
+    if len(offsets) == 0 or offsets[-1] != position:
+        # the last record is not terminated by a newline
+        offsets = np.append(offsets, position)
+    return offsets.astype(np.int64)
+
+def _build_csv_index(csv_path: Path) -> pd.DataFrame:
+    offsets = scan_record_offsets(csv_path)
+    # the ids are read with the C parser (without converting the other columns) in the same record order
+    df = pd.read_csv(csv_path, usecols=["Model ID", "Revision ID", "Type", "Namespace"], dtype=str)
+    if len(df) != len(offsets) - 1:
+        raise ValueError(f"Found {len(offsets) - 1} records in {csv_path}, but pandas read {len(df)} rows")
+    return pd.DataFrame({
+        "revision_id": df["Revision ID"].to_numpy(),
+        "type": df["Type"].astype("category").to_numpy(),
+        "namespace": df["Namespace"].astype("category").to_numpy(),
+        "offset": offsets[:-1],
+        "length": np.diff(offsets)
+    }, index=pd.Index(df["Model ID"], name="model_id"))
+
+def build_csv_index(csv_path: Path, use_cache=True) -> pd.DataFrame:
+    """
+    Returns the index of a csv: revision_id, type, namespace, byte offset and byte length of every model's record,
+    indexed by model_id. With use_cache, the index is cached below constants.DATA_CACHE and only rebuilt if the
+    csv changed (see cache.load_cached).
+    """
+    if use_cache:
+        return cache.load_cached(csv_path, _INDEX_KIND, _build_csv_index)
+    return _build_csv_index(csv_path)
+
+def _build_csv_dtypes(csv_path: Path) -> pd.DataFrame:
+    # the Model JSON is only measured instead of kept in memory, the other columns are inferred like in parse_model
+    df = pd.read_csv(csv_path, dtype={"Type": "category", "Namespace": "category"}, converters={"Model JSON": len})
+    dtypes = df.dtypes.astype(str)
+    if "Model JSON" in df.columns and len(df):
+        # read_csv returns a column without any value as float64 NaN
+        dtypes["Model JSON"] = "object" if (df["Model JSON"] > 0).any() else "float64"
+    return pd.DataFrame([dtypes.to_numpy()], columns=dtypes.index)
+
+def build_csv_dtypes(csv_path: Path, use_cache=True) -> pd.DataFrame:
+    """
+    Returns the dtypes that parser.parse_model infers for the columns of a csv (as one row of dtype names), so that
+    the records read by ModelIndex.get_models get the dtypes of the full parse. Cached like build_csv_index.
+    """
+    if use_cache:
+        return cache.load_cached(csv_path, _DTYPES_KIND, _build_csv_dtypes)
+    return _build_csv_dtypes(csv_path)
+
+def _get_common_dtype(dtypes: pd.Series, n_csvs: int) -> np.dtype:
+    # promoted like concatenating the parsed csvs: numeric columns stay numeric (float if a csv lacks the column),
+    # all other combinations are object columns
+    dtypes = [np.dtype(dtype) for dtype in dtypes.dropna()]
+    if len(dtypes) < n_csvs:
+        dtypes.append(np.dtype(np.float64))
+    common = np.result_type(*dtypes)
+    return common if common.kind in "biuf" or len(set(dtypes)) == 1 else np.dtype(object)
+
+class ModelIndex:
+    """
+    Maps model ids (and revisions) to the csv, byte offset and length of their record, so that single models are
+    read by seeking into their csv instead of parsing the dataset, e.g.
+        index = ModelIndex()
+        model_json = index.get_model_json(model_id)
+        df = index.get_models(index.sample(100, namespace=BPMN2_NAMESPACE))
+    """
+
+    def __init__(self, csv_paths=None, use_cache=True):
+        if csv_paths is None:
+            csv_paths = get_csv_paths()
+        self.csv_paths = [Path(csv_path) for csv_path in csv_paths]
+        _logger.info("Loading the model index of %d csv", len(self.csv_paths))
+        dfs = [build_csv_index(csv_path, use_cache).assign(csv=i) for i, csv_path in enumerate(self.csv_paths)]
+        self.df = pd.concat(dfs) if dfs else pd.DataFrame(columns=["revision_id", "type", "namespace", "offset",
+                                                                   "length", "csv"])
+        # categories of all csvs, concatenating categoricals with different categories returns object columns
+        self.df = self.df.astype({"type": "category", "namespace": "category"})
+        dtypes = pd.concat([build_csv_dtypes(csv_path, use_cache) for csv_path in self.csv_paths]) if dfs \
+            else pd.DataFrame()
+        self._dtypes = {column: _get_common_dtype(dtypes[column], len(dtypes)) for column in dtypes.columns
+                        if column not in ("Model ID", "Type", "Namespace")}
+        self._headers: Dict[int, bytes] = {}
+
+    def __len__(self):
+        return len(self.df)
+
+    def __contains__(self, model_id):
+        return model_id in self.df.index
+
+    def _get_header(self, csv: int) -> bytes:
+        if csv not in self._headers:
+            offsets = self.df.loc[self.df["csv"] == csv, "offset"]
+            with open(self.csv_paths[csv], "rb") as f:
+                # a csv without records consists of its header
+                self._headers[csv] = f.read(int(offsets.min())) if len(offsets) else f.read()
+        return self._headers[csv]
+
+    def _get_entries(self, model_id: str, revision_id: Optional[str] = None) -> pd.DataFrame:
+        if model_id not in self.df.index:
+            raise KeyError(f"Unknown model id: {model_id}")
+        entries = self.df.loc[[model_id]]
+        if revision_id is not None:
+            entries = entries[entries["revision_id"] == revision_id]
+            if len(entries) == 0:
+                raise KeyError(f"Unknown revision id {revision_id} of model {model_id}")
+        return entries
+
+    def _read_record(self, csv: int, offset: int, length: int) -> bytes:
+        with open(self.csv_paths[csv], "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def get_model_json(self, model_id: str, revision_id: Optional[str] = None) -> str:
+        """
+        Returns the Model JSON of a model (of its first record, if the model occurs several times and no revision_id
+        is given) by reading only its record.
+        """
+        entry = self._get_entries(model_id, revision_id).iloc[0]
+        header = next(csv.reader(io.StringIO(self._get_header(entry["csv"]).decode("utf-8"))))
+        record = self._read_record(entry["csv"], entry["offset"], entry["length"])
+        values = next(csv.reader(io.StringIO(record.decode("utf-8"))))
+        return values[header.index("Model JSON")]
+
+    def get_models(self, model_ids: List[str]) -> pd.DataFrame:
+        """
+        Returns the rows of the models formatted like parser.parse_model, in the order of model_ids. Only the
+        records of these models are read, grouped by csv and in file order. The columns have the dtypes of the
+        full parse (see build_csv_dtypes) instead of the dtypes inferred from the selected records, and type and
+        namespace are categoricals with the categories of all indexed csvs.
+        """
+        missing = [model_id for model_id in model_ids if model_id not in self.df.index]
+        if missing:
+            raise KeyError(f"Unknown model ids: {missing[:10]}")
+        if not self.csv_paths:
+            return pd.DataFrame()
+        entries = self.df.loc[self.df.index.isin(model_ids)].sort_values(["csv", "offset"])
+        # text columns are read as strings, so that e.g. ids of digits are not inferred as numbers
+        read_dtypes = {column: str for column, dtype in self._dtypes.items() if dtype == object}
+        dfs = []
+        for csv_index, group in entries.groupby("csv", sort=False):
+            with open(self.csv_paths[csv_index], "rb") as f:
+                records = []
+                for offset, length in zip(group["offset"], group["length"]):
+                    f.seek(offset)
+                    records.append(f.read(length))
+            dfs.append(parse_csv_raw(io.BytesIO(self._get_header(csv_index) + b"".join(records)), dtype=read_dtypes))
+        if not dfs:
+            dfs.append(parse_csv_raw(io.BytesIO(self._get_header(0)), dtype=read_dtypes))
+        dtypes = {column.replace(" ", "_").lower(): dtype for column, dtype in self._dtypes.items()}
+        dtypes.update({column: self.df[column].dtype for column in ("type", "namespace")})
+        df = pd.concat(dfs)
+        df = df.astype({column: dtype for column, dtype in dtypes.items() if column in df.columns})
+        return df.loc[pd.unique(np.asarray(model_ids, dtype=object))]
+
+    def sample(self, n: int, namespace: Optional[str] = None, random_state=None) -> List[str]:
+        """
+        Returns the ids of n randomly sampled models (of namespace), to be read with get_models.
+        """
+        df = self.df if namespace is None else self.df[self.df["namespace"] == namespace]
+        return df.sample(n, random_state=random_state).index.unique().tolist()
+
+_default_index = None
+
+def get_model_index() -> ModelIndex:
+    """
+    Returns the index of the dataset csvs that is used by get_model_json and get_models, it is loaded on first use.
+    """
+    global _default_index
+    if _default_index is None:
+        _default_index = ModelIndex()
+    return _default_index
+
+def get_model_json(model_id: str, revision_id: Optional[str] = None) -> str:
+    return get_model_index().get_model_json(model_id, revision_id)
+
+def get_models(model_ids: List[str]) -> pd.DataFrame:
+    return get_model_index().get_models(model_ids)
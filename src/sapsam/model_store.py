@@ -0,0 +1,223 @@
+import os
+import json
+import mmap
+import zlib
+import logging
+from functools import partial
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from sapsam import cache, decoders
+from sapsam.constants import DATA_MODEL_STORE
+from sapsam.parser import get_csv_paths, iter_csv_raw, map_csvs
+
+# optional, faster and smaller than zlib, which is used if zstandard is not installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_logger = logging.getLogger(__name__)
+
+# "full" keeps the Model JSON as it is, "semantic" drops the layout (see strip_layout)
+MODEL_STORE_KINDS = ["full", "semantic"]
+CODECS = ["zstd", "zlib"]
+
+# element keys and properties that only describe how a model is drawn, none of the parsers reads them
+LAYOUT_KEYS = {"bounds", "dockers"}
+LAYOUT_PROPERTIES = {"bgcolor", "bordercolor", "fontcolor", "fontfamily", "fontsize", "textcolor"}
+
+def strip_layout(model_dict: dict) -> dict:
+    """
+    Removes the bounds, dockers and styling properties of the model and all its (nested) childShapes in place,
+    the ids, stencils, properties, outgoing and glossary links that the parsers use are kept.
+    """
+    stack = [model_dict]
+    while stack:
+        element = stack.pop()
+        for key in LAYOUT_KEYS:
+            element.pop(key, None)
+        properties = element.get("properties")
+        if isinstance(properties, dict):
+            for key in LAYOUT_PROPERTIES:
+                properties.pop(key, None)
+        stack.extend(element.get("childShapes", []))
+    return model_dict
+
+def _dumps(model_dict: dict) -> bytes:
+    if decoders.orjson is not None:
+        try:
+            return decoders.orjson.dumps(model_dict)
+        except TypeError:
+            # e.g. integers beyond 64 bit
+            pass
+    return json.dumps(model_dict, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+def _get_compress(codec: str):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress
+    return partial(zlib.compress, level=6)
+
+def _get_decompress(codec: str):
+    if codec == "zstd":
+        if zstandard is None:
+            raise ImportError("Reading a zstd model store requires the zstandard package")
+        return zstandard.ZstdDecompressor().decompress
+    return zlib.decompress
+
+def get_store_paths(csv_path: Path, kind: str, codec: str, store_root=DATA_MODEL_STORE):
+    """
+    Returns the index (parquet) and blob file of the store of csv_path. The index has the columns of
+    parser.parse_csv_raw with the model_json replaced by the offset and length of the model's blob.
+    """
+    index_path = cache.get_cache_path(csv_path, kind, store_root)
+    return index_path, index_path.with_suffix(f".{codec}")
+
+def _build_csv_store(csv_path: Path, kind: str, json_backend="auto", batch_size=1000, store_root=DATA_MODEL_STORE):
+    codec = "zstd" if zstandard is not None else "zlib"
+    index_path, blob_path = get_store_paths(csv_path, kind, codec, store_root)
+    blob_path.parent.mkdir(parents=True, exist_ok=True)
+    compress = _get_compress(codec)
+    loads = decoders.get_json_loads(json_backend)
+    dfs = []
+    offset = 0
+    tmp_path = blob_path.with_name(f"{blob_path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        for df in iter_csv_raw(csv_path, batch_size):
+            offsets, lengths = [], []
+            for model_json in df["model_json"]:
+                if not isinstance(model_json, str):
+                    # missing Model JSON, read back as NaN
+                    offsets.append(offset)
+                    lengths.append(-1)
+                    continue
+                data = _dumps(strip_layout(loads(model_json))) if kind == "semantic" else model_json.encode("utf-8")
+                blob = compress(data)
+                f.write(blob)
+                offsets.append(offset)
+                lengths.append(len(blob))
+                offset += len(blob)
+            position = df.columns.get_loc("model_json")
+            df = df.drop(columns="model_json")
+            df.insert(position, "offset", np.array(offsets, dtype=np.int64))
+            df.insert(position + 1, "length", np.array(lengths, dtype=np.int64))
+            dfs.append(df)
+    os.replace(tmp_path, blob_path)
+    for other_codec in CODECS:
+        # a store built before zstandard was (un)installed
+        if other_codec != codec:
+            get_store_paths(csv_path, kind, other_codec, store_root)[1].unlink(missing_ok=True)
+    # concatenating the chunks turns categoricals with different categories into object columns
+    df = pd.concat(dfs).astype({column: "category" for column in ("type", "namespace") if column in dfs[0].columns})
+    df["codec"] = pd.Categorical([codec] * len(df))
+    # written last, the index marks the store as fresh (see cache.is_fresh)
+    cache.write_cache(df, csv_path, kind, store_root)
+    _logger.info("Stored %d models of %s in %s (%.1f MB)", len(df), csv_path, blob_path, offset / 1e6)
+    return index_path
+
+def build_model_store(csv_paths=None, semantic_only=False, n_workers=1, json_backend="auto", batch_size=1000,
+                      rebuild=False, store_root=DATA_MODEL_STORE) -> List[Path]:
+    """
+    Stores the models of every csv as compressed blobs (zstd if zstandard is installed, else zlib) below
+    store_root, one blob file and one index per csv. With semantic_only, the layout is dropped before the Model
+    JSON is compressed (see strip_layout), which shrinks the decompressed Model JSON by about 40% but saves little after
+    compression (22 MB instead of 24 MB for a synthetic 280 MB dataset). The csvs are read in
+    batches of batch_size models and stored in parallel with n_workers (see parser.map_csvs). A store is only
+    rebuilt if its csv changed or with rebuild. Returns the paths of the indexes.
+    """
+    if csv_paths is None:
+        csv_paths = get_csv_paths()
+    kind = "semantic" if semantic_only else "full"
+    if not rebuild:
+        csv_paths = [csv_path for csv_path in csv_paths if not cache.is_fresh(csv_path, kind, store_root)]
+    func = partial(_build_csv_store, kind=kind, json_backend=json_backend, batch_size=batch_size,
+                   store_root=store_root)
+    return list(map_csvs(func, csv_paths, n_workers))
+
+class ModelStoreReader:
+    """
+    Reads the models of one csv from its store, the blob file is memory mapped so that models are decompressed
+    one by one without reading the file, e.g.
+        with ModelStoreReader(csv_path, semantic_only=True) as reader:
+            model_json = reader.get_model_json(model_id)
+            df = reader.read()
+    The store is built on first use (and rebuilt if the csv changed).
+    """
+
+    def __init__(self, csv_path: Path, semantic_only=False, store_root=DATA_MODEL_STORE):
+        kind = "semantic" if semantic_only else "full"
+        if not cache.is_fresh(csv_path, kind, store_root):
+            _build_csv_store(csv_path, kind, store_root=store_root)
+        index_path = cache.get_cache_path(csv_path, kind, store_root)
+        self.df = pd.read_parquet(index_path)
+        codec = self.df["codec"].iloc[0] if len(self.df) else CODECS[-1]
+        self.df = self.df.drop(columns="codec")
+        # parquet returns missing strings as None, restore the NaN values that read_csv produces
+        for column in self.df.columns[self.df.dtypes == object]:
+            self.df[column] = self.df[column].where(self.df[column].notna(), np.nan)
+        self._decompress = _get_decompress(codec)
+        self._file = open(get_store_paths(csv_path, kind, codec, store_root)[1], "rb")
+        # empty files cannot be mapped
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) \
+            if os.fstat(self._file.fileno()).st_size > 0 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+
+    def __len__(self):
+        return len(self.df)
+
+    def _decode(self, offset: int, length: int):
+        if length < 0:
+            return np.nan
+        return self._decompress(self._mmap[offset:offset + length]).decode("utf-8")
+
+    def get_model_json(self, model_id: str) -> str:
+        """
+        Returns the Model JSON of a model (of its first row, if the model id is duplicated).
+        """
+        if model_id not in self.df.index:
+            raise KeyError(f"Unknown model id: {model_id}")
+        entry = self.df.loc[[model_id]].iloc[0]
+        return self._decode(entry["offset"], entry["length"])
+
+    def _read_rows(self, df: pd.DataFrame, columns=None) -> pd.DataFrame:
+        position = df.columns.get_loc("offset")
+        model_jsons = [self._decode(o, n) for o, n in zip(df["offset"].to_numpy(), df["length"].to_numpy())] \
+            if columns is None or "model_json" in columns else None
+        df = df.drop(columns=["offset", "length"])
+        if model_jsons is not None:
+            df.insert(position, "model_json", model_jsons)
+        return df if columns is None else df[columns]
+
+    def read(self, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Returns the models formatted like parser.parse_csv_raw, columns restricts the returned columns. Without
+        model_json in columns, no blob is decompressed.
+        """
+        return self._read_rows(self.df, columns)
+
+    def iter_batches(self, batch_size: int, columns: Optional[List[str]] = None) -> Iterator[pd.DataFrame]:
+        """
+        Same as read in batches of batch_size models, so that only one batch of decompressed models is in memory.
+        """
+        for start in range(0, len(self.df), batch_size):
+            yield self._read_rows(self.df.iloc[start:start + batch_size], columns)
+
+def read_model_store(csv_path: Path, semantic_only=False, columns=None, store_root=DATA_MODEL_STORE) -> pd.DataFrame:
+    """
+    Returns the models of a csv from its store, formatted like parser.parse_csv_raw, see ModelStoreReader.
+    """
+    with ModelStoreReader(csv_path, semantic_only, store_root) as reader:
+        return reader.read(columns)
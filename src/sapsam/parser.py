@@ -1,13 +1,17 @@
 import os
-import json
+import hashlib
 import logging
 from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Iterator
 
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
+from sapsam import cache, decoders
 from sapsam.constants import BPMN2_NAMESPACE, DATA_DATASET, DATA_CONVENTIONS
 
 _logger = logging.getLogger(__name__)
@@ -18,35 +22,116 @@ def get_csv_paths(ds_root=DATA_DATASET) -> List[Path]:
     _logger.info("Found %d csvs", len(paths))
     return paths
 
-def parse_csv_raw(csv_path: Path, **kwargs):
-    df = (
-        pd.read_csv(csv_path, dtype={"Type": "category", "Namespace": "category"}, **kwargs)
+def _read_csv_raw(csv_path: Path, dtype=None, **kwargs) -> pd.DataFrame:
+    return (
+        pd.read_csv(csv_path, dtype={"Type": "category", "Namespace": "category", **(dtype or {})}, **kwargs)
         .rename(columns=lambda s: s.replace(" ", "_").lower())
         .set_index("model_id")
     )
+
+def _check_csv_raw(df: pd.DataFrame):
     if df.index.duplicated().any():
         _logger.warning("Warning: CSV has %d duplicate model ids", df.index.duplicated().sum())
-    assert not df["namespace"].isna().any(), "csv has NA namespace entries, this should not happen."
+    if "namespace" in df.columns:
+        assert not df["namespace"].isna().any(), "csv has NA namespace entries, this should not happen."
+
+def parse_csv_raw(csv_path: Path, **kwargs):
+    df = _read_csv_raw(csv_path, **kwargs)
+    _check_csv_raw(df)
     return df
 
-def parse_model_metadata(csv_paths=None) -> pd.DataFrame:
+def iter_csv_raw(csv_path: Path, chunksize: int, **kwargs) -> Iterator[pd.DataFrame]:
+    """
+    Reads a csv in chunks of chunksize models, each chunk is formatted like the result of parse_csv_raw.
+    """
+    reader = pd.read_csv(csv_path, dtype={"Type": "category", "Namespace": "category"}, chunksize=chunksize, **kwargs)
+    with reader:
+        for df in reader:
+            yield df.rename(columns=lambda s: s.replace(" ", "_").lower()).set_index("model_id")
+
+def _exclude_model_json(column: str) -> bool:
+    # module level (instead of a lambda) so that it can be pickled to worker processes
+    return column != "Model JSON"
+
+def map_csvs(func, csv_paths: List[Path], n_workers=1, chunksize=1) -> Iterator:
+    """
+    Applies func to every csv path and yields the results in the order of csv_paths.
+    With n_workers != 1 the csvs are processed in a process pool (n_workers=None uses all cores),
+    chunksize controls how many csvs are sent to a worker at once.
+    func has to be picklable, i.e. defined at module level or a functools.partial of such a function.
+    """
+    if n_workers == 1:
+        yield from (func(p) for p in tqdm(csv_paths))
+        return
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        yield from tqdm(executor.map(func, csv_paths, chunksize=chunksize), total=len(csv_paths))
+
+def _read_csv_cached(csv_path: Path, kind: str, columns=None, **kwargs) -> pd.DataFrame:
+    df = cache.load_cached(csv_path, kind, partial(_read_csv_raw, **kwargs), columns)
+    # parquet returns missing strings as None, restore the NaN values that read_csv produces
+    for column in df.columns[df.dtypes == object]:
+        df[column] = df[column].where(df[column].notna(), np.nan)
+    return df
+
+def _parse_csvs_raw(csv_paths: List[Path], n_workers=1, chunksize=1, cache_kind=None, columns=None,
+                    **kwargs) -> pd.DataFrame:
+    if cache_kind is None:
+        func = partial(_read_csv_raw, **kwargs)
+    else:
+        func = partial(_read_csv_cached, kind=cache_kind, columns=columns, **kwargs)
+    dfs = []
+    for df in map_csvs(func, csv_paths, n_workers, chunksize):
+        # checks run in the main process, so the duplicate id warning is logged like for parse_csv_raw
+        _check_csv_raw(df)
+        dfs.append(df)
+    df = pd.concat(dfs)
+    return df if columns is None or cache_kind is not None else df[columns]
+
+def parse_model_metadata(csv_paths=None, n_workers=1, chunksize=1, use_cache=True, columns=None) -> pd.DataFrame:
+    """
+    With use_cache, every csv is parsed once and then loaded from a parquet file below constants.DATA_CACHE,
+    which is rebuilt when the csv changes. columns restricts the loaded columns (the model_id index is always kept).
+    """
     if csv_paths is None:
         csv_paths = get_csv_paths()
     _logger.info("Starting to parse %d csv excluding model json", len(csv_paths))
 
     # exclude "Model JSON" column to speed up import and reduce memory usage
-    dfs = [parse_csv_raw(p, usecols=lambda s: s != "Model JSON") for p in tqdm(csv_paths)]
-    df = pd.concat(dfs)
+    df = _parse_csvs_raw(csv_paths, n_workers, chunksize, cache_kind="metadata" if use_cache else None,
+                         columns=columns, usecols=_exclude_model_json)
     _logger.info("Parsed %d models", len(df))
     return df
 
-def parse_model(csv_paths=None) -> pd.DataFrame:
+def _read_model_store(csv_path: Path, model_store: str, columns=None) -> pd.DataFrame:
+    # imported here, model_store imports this module
+    from sapsam.model_store import read_model_store
+    return read_model_store(csv_path, semantic_only=model_store == "semantic", columns=columns)
+
+def _check_model_store(model_store):
+    if model_store not in (None, "full", "semantic"):
+        raise ValueError(f"Unknown model store: {model_store}, available: None, 'full', 'semantic'")
+
+def parse_model(csv_paths=None, n_workers=1, chunksize=1, use_cache=True, columns=None,
+                model_store=None) -> pd.DataFrame:
+    """
+    See parse_model_metadata for use_cache and columns.
+    With model_store ("full" or "semantic"), the models are read from the compressed model store instead of the
+    csvs (which is built on first use, see model_store.build_model_store), "semantic" returns the Model JSON
+    without layout. use_cache does not apply to the store.
+    """
     if csv_paths is None:
         csv_paths = get_csv_paths()
+    _check_model_store(model_store)
     _logger.info("Starting to parse %d csv", len(csv_paths))
 
-    dfs = tqdm([parse_csv_raw(p) for p in csv_paths])
-    df = pd.concat(dfs)
+    if model_store is not None:
+        func = partial(_read_model_store, model_store=model_store, columns=columns)
+        df = pd.concat(list(map_csvs(func, csv_paths, n_workers, chunksize)))
+        _check_csv_raw(df)
+        _logger.info("Parsed %d models", len(df))
+        return df
+    df = _parse_csvs_raw(csv_paths, n_workers, chunksize, cache_kind="models" if use_cache else None,
+                         columns=columns)
     _logger.info("Parsed %d models", len(df))
     return df
 
@@ -58,79 +143,220 @@ def parse_conventions() -> pd.DataFrame:
         raise ValueError("No conventions file found")
 
 class BpmnModelParser:
-    def __init__(self, parse_outgoing=False, parse_parent=False):
+    def __init__(self, parse_outgoing=False, parse_parent=False, json_backend="auto", model_store=None,
+                 namespace=BPMN2_NAMESPACE):
+        """
+        namespace restricts the parsed models to a namespace, None parses the models of all namespaces and adds
+        a namespace column to the elements.
+        json_backend selects how the Model JSON is decoded, see decoders.get_json_loads. The default uses orjson
+        or pysimdjson if one of them is installed and falls back to the json module.
+        With model_store ("full" or "semantic"), the models are read from the compressed model store instead of
+        the csvs, see parse_model. Both stores keep everything the elements are parsed from, so the element cache
+        is shared with the csvs.
+        """
+        _check_model_store(model_store)
         self.parse_outgoing = parse_outgoing
         self.parse_parent = parse_parent
+        self.json_backend = json_backend
+        self.model_store = model_store
+        self.namespace = namespace
 
-    def parse_model_elements(self, csv_paths=None) -> pd.DataFrame:
+    def parse_model_elements(self, csv_paths=None, n_workers=1, chunksize=1, use_cache=True,
+                             columns=None, model_ids=None) -> pd.DataFrame:
+        """
+        With use_cache, the elements of every csv are cached as parquet file below constants.DATA_CACHE
+        (separately for each combination of parse_outgoing, parse_parent and namespace) and only re-parsed if the csv
+        changed.
+        columns restricts the loaded columns (the model_id, element_id index is always kept).
+        model_ids restricts the result to these models, if a csv is not cached only their Model JSON is decoded.
+        """
         if csv_paths is None:
             csv_paths = get_csv_paths()
         _logger.info("Starting to parse %d csv", len(csv_paths))
-        dfs = [self._parse_bpmn_model_elements_csv(p) for p in tqdm(csv_paths)]
+        if use_cache:
+            func = partial(self._load_bpmn_model_elements_csv, columns=columns, model_ids=model_ids)
+        else:
+            func = partial(self._parse_bpmn_model_elements_csv, model_ids=model_ids)
+        dfs = list(map_csvs(func, csv_paths, n_workers, chunksize))
         df = pd.concat(dfs)
+        return df if columns is None or use_cache else df[columns]
+
+    def _get_cache_kind(self) -> str:
+        kind = "bpmn_elements"
+        if self.parse_outgoing:
+            kind += "_outgoing"
+        if self.parse_parent:
+            kind += "_parent"
+        if self.namespace is None:
+            kind += "_all_namespaces"
+        elif self.namespace != BPMN2_NAMESPACE:
+            kind += "_" + hashlib.sha1(self.namespace.encode("utf-8")).hexdigest()[:10]
+        return kind
+
+    def _load_bpmn_model_elements_csv(self, csv_path: Path, columns=None, model_ids=None) -> pd.DataFrame:
+        kind = self._get_cache_kind()
+        if model_ids is not None and not cache.is_fresh(csv_path, kind):
+            # the elements of a subset of models must not be cached, so only the selected models are parsed
+            df = self._parse_bpmn_model_elements_csv(csv_path, model_ids)
+            return df if columns is None else df[columns]
+        df = cache.load_cached(csv_path, kind, self._parse_bpmn_model_elements_csv, columns)
+        if model_ids is not None:
+            df = df[df.index.get_level_values("model_id").isin(model_ids)]
+        if "outgoing" in df.columns:
+            # parquet returns list columns as numpy arrays
+            df = df.assign(outgoing=[list(v) for v in df["outgoing"]])
         return df
 
-    def _parse_bpmn_model_elements_csv(self, csv_path: Path) -> pd.DataFrame:
-        df = parse_csv_raw(csv_path)
-        df_bpmn = df.query(f"namespace == '{BPMN2_NAMESPACE}'")
-        model_dfs = [self._parse_df_row(t) for t in df_bpmn.reset_index().itertuples()]
+    def iter_model_elements(self, csv_paths=None, batch_size=None, use_cache=True) -> Iterator[pd.DataFrame]:
+        """
+        Yields the model elements batch by batch instead of concatenating them into one DataFrame, so that callers
+        can aggregate or write out the elements with bounded memory, e.g.
+            category_counts = sum(batch.category.value_counts() for batch in parser.iter_model_elements())
+        Without batch_size, one batch is yielded per csv (loaded from the cache with use_cache). With batch_size,
+        the csvs are read in chunks of batch_size models and one batch is yielded per chunk, so not even a single
+        csv is held in memory.
+        """
+        if csv_paths is None:
+            csv_paths = get_csv_paths()
+        _logger.info("Starting to parse %d csv", len(csv_paths))
+        for csv_path in tqdm(csv_paths):
+            if batch_size is None:
+                if use_cache:
+                    yield self._load_bpmn_model_elements_csv(csv_path)
+                else:
+                    yield self._parse_bpmn_model_elements_csv(csv_path)
+                continue
+            for df in self._iter_models_csv(csv_path, batch_size):
+                if self.namespace is None or (df["namespace"] == self.namespace).any():
+                    yield self._parse_bpmn_model_elements_df(df)
+
+    def write_model_elements(self, out_dir: Path, csv_paths=None, batch_size=None) -> List[Path]:
+        """
+        Writes the batches of iter_model_elements to a partitioned parquet dataset, one file per batch named after
+        its csv. The dataset can be read with pd.read_parquet(out_dir) (optionally with columns or filters).
+        Returns the paths of the written files.
+        """
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        if csv_paths is None:
+            csv_paths = get_csv_paths()
+        paths = []
+        for csv_path in csv_paths:
+            batches = self.iter_model_elements([csv_path], batch_size, use_cache=False)
+            for i, batch in enumerate(batches):
+                path = out_dir / f"{csv_path.stem}-{i:05d}.parquet"
+                batch.to_parquet(path)
+                paths.append(path)
+        _logger.info("Wrote %d parquet files to %s", len(paths), out_dir)
+        return paths
+
+    def _read_models_csv(self, csv_path: Path) -> pd.DataFrame:
+        if self.model_store is None:
+            return parse_csv_raw(csv_path)
+        return _read_model_store(csv_path, self.model_store)
+
+    def _iter_models_csv(self, csv_path: Path, batch_size: int) -> Iterator[pd.DataFrame]:
+        if self.model_store is None:
+            yield from iter_csv_raw(csv_path, batch_size)
+            return
+        from sapsam.model_store import ModelStoreReader
+        with ModelStoreReader(csv_path, semantic_only=self.model_store == "semantic") as reader:
+            yield from reader.iter_batches(batch_size)
+
+    def _parse_bpmn_model_elements_csv(self, csv_path: Path, model_ids=None) -> pd.DataFrame:
+        return self._parse_bpmn_model_elements_df(self._read_models_csv(csv_path), model_ids)
+
+    def _parse_bpmn_model_elements_df(self, df: pd.DataFrame, model_ids=None) -> pd.DataFrame:
+        df_bpmn = df if self.namespace is None else df[df["namespace"] == self.namespace]
+        if model_ids is not None:
+            df_bpmn = df_bpmn[df_bpmn.index.isin(model_ids)]
+        # accumulate the elements of all models column by column and build a single DataFrame at the end,
+        # creating and concatenating one DataFrame per model is an order of magnitude slower
+        columns = {name: [] for name in self._get_column_names()}
+        loads = decoders.get_json_loads(self.json_backend)
+        counts = [self._append_elements(loads(model_json), columns) for model_json in df_bpmn["model_json"]]
+        df_elements = pd.DataFrame(columns)
+        df_elements["glossary_link_id"] = _convert_glossary_ids(df_elements["glossary_link_id"])
+        df_elements.insert(0, "model_id", np.repeat(df_bpmn.index.to_numpy(), counts))
+        df_elements["name"] = np.repeat(df_bpmn["name"].to_numpy(), counts)
+        if self.namespace is None:
+            df_elements["namespace"] = pd.Categorical(np.repeat(df_bpmn["namespace"].to_numpy(), counts))
         return (
-            pd.concat(model_dfs)
+            df_elements
             .set_index(["model_id", "element_id"])
             .astype({"category": "category"})  # convert column category to dtype categorical to save memory
         )
 
-    def _parse_df_row(self, row_tuple):
-        model_dict = json.loads(row_tuple.model_json)
-        elements = self._get_elements_flat(model_dict)
-        df = pd.DataFrame.from_records(elements)
-        
-        if 'glossary_link_id' in df.columns:
-            def convert_glossary_ids(value):
-                if pd.notna(value):
-                    value = str(value).replace("[", "")\
-                        .replace("]", "")\
-                        .replace("/glossary/", "")\
-                        .replace("'", "")
-                return value
-        
-            df["glossary_link_id"] = df["glossary_link_id"].apply(convert_glossary_ids)
-
-        df["model_id"] = row_tuple.model_id
-        df["name"] = row_tuple.name
-        return df
+    def _get_column_names(self) -> List[str]:
+        names = ["element_id", "category", "label", "glossary_link_id"]
+        if self.parse_parent:
+            names.append("parent")
+        if self.parse_outgoing:
+            names.append("outgoing")
+        return names
+
+    def get_model_elements(self, model_dict) -> Dict[str, list]:
+        """
+        Returns the elements of one model (its Model JSON decoded as dict) column by column: element_id, category,
+        label, glossary_link_id (unconverted) and parent / outgoing if they are parsed.
+        """
+        columns = {name: [] for name in self._get_column_names()}
+        self._append_elements(model_dict, columns)
+        return columns
 
     def _get_elements_flat(self, model_dict) -> List[Dict[str, str]]:
         """
         Parses the recursive childShapes and produces a flat list of model elements with the most important attributes
         such as id, category, label, outgoing, and parent elements.
         """
-        stack = deque([model_dict])
-        elements_flat = []
+        columns = self.get_model_elements(model_dict)
+        return [dict(zip(columns, values)) for values in zip(*columns.values())]
 
-        while len(stack) > 0:
-            element = stack.pop()
+    def _append_elements(self, model_dict, columns: Dict[str, list]) -> int:
+        """
+        Parses the recursive childShapes and appends the attributes of every model element to the lists in columns
+        (see _get_column_names). Returns the number of appended elements.
+        """
+        root_id = model_dict["resourceId"]
+        element_ids, categories, labels = columns["element_id"], columns["category"], columns["label"]
+        glossary_link_ids = columns["glossary_link_id"]
+        parents, outgoing = columns.get("parent"), columns.get("outgoing")
+        stack = deque([(model_dict, None)])
+        n_elements = 0
 
-            for c in element.get("childShapes", []):
-                c["parent"] = element["resourceId"]
-                stack.append(c)
+        while len(stack) > 0:
+            element, parent = stack.pop()
+            element_id = element["resourceId"]
+            stack.extend((c, element_id) for c in element.get("childShapes", []))
 
             # don't append root as element
-            if element["resourceId"] == model_dict["resourceId"]:
+            if element_id == root_id:
                 continue
 
             # NOTE: it's possible to add other attributes here, such as the bounds of an element
-            record = {
-                "element_id": element["resourceId"],
-                "category": element["stencil"].get("id") if "stencil" in element else None,
-                "label": element["properties"].get("name"),
-                "glossary_link_id": str(element.get("glossaryLinks", {}).get("name", None))
-            }
-            if self.parse_parent:
-                record["parent"] = element.get("parent")
-            if self.parse_outgoing:
-                record["outgoing"] = [v for d in element.get("outgoing", []) for v in d.values()]
-
-            elements_flat.append(record)
-
-        return elements_flat
+            element_ids.append(element_id)
+            categories.append(element["stencil"].get("id") if "stencil" in element else None)
+            labels.append(element.get("properties", {}).get("name"))
+            glossary_link_ids.append(str(element.get("glossaryLinks", {}).get("name", None)))
+            if parents is not None:
+                parents.append(parent)
+            if outgoing is not None:
+                outgoing.append([v for d in element.get("outgoing", []) for v in d.values()])
+            n_elements += 1
+
+        return n_elements
+
+def _convert_glossary_ids(glossary_link_ids: pd.Series) -> pd.Series:
+    # "['/glossary/<id1>', '/glossary/<id2>']" -> "<id1>, <id2>", only few elements have glossary links,
+    # so the replacements are restricted to the elements that are not "None"
+    linked = glossary_link_ids != "None"
+    if not linked.any():
+        return glossary_link_ids
+    glossary_link_ids = glossary_link_ids.copy()
+    glossary_link_ids[linked] = (
+        glossary_link_ids[linked].str.replace("[", "", regex=False)
+        .str.replace("]", "", regex=False)
+        .str.replace("/glossary/", "", regex=False)
+        .str.replace("'", "", regex=False)
+    )
+    return glossary_link_ids
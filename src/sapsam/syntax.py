@@ -0,0 +1,215 @@
+import json
+import logging
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import pandas as pd
+from tqdm import tqdm
+
+from sapsam import decoders
+from sapsam.constants import BPMN2_NAMESPACE
+from sapsam.parser import BpmnModelParser, get_csv_paths, map_csvs, parse_csv_raw
+
+_logger = logging.getLogger(__name__)
+
+# Local BPMN syntax rules that are decided on the childShapes/outgoing structure of the Model JSON. They are a subset
+# of the checks of the remote syntax checker and report their own rule names (SYNTAX_RULES), not the codes of the
+# remote checker. The result has the shape of the remote result ({'errors': {resourceId: [rule, ...]}, ...}) and is
+# tagged with 'source': 'local', so that local and remote results stored side by side can be told apart. Models with
+# elements whose rules need more context than the model structure (REMOTE_STENCILS) or with unknown stencils are
+# left to the remote syntax checker.
+
+ACTIVITY_STENCILS = {"Task", "CollapsedSubprocess", "Subprocess", "CollapsedEventSubprocess", "EventSubprocess"}
+EVENT_SUBPROCESS_STENCILS = {"CollapsedEventSubprocess", "EventSubprocess"}
+GATEWAY_STENCILS = {"Exclusive_Databased_Gateway", "EventbasedGateway", "ParallelGateway", "InclusiveGateway",
+                    "ComplexGateway"}
+POOL_STENCILS = {"Pool", "CollapsedPool", "VerticalPool", "CollapsedVerticalPool"}
+OTHER_STENCILS = {"BPMNDiagram", "Lane", "VerticalLane", "processparticipant", "Group", "TextAnnotation", "ITSystem",
+                  "DataObject", "DataStore", "Message", "Association_Undirected", "Association_Unidirectional",
+                  "Association_Bidirectional"}
+
+# event based gateways, compensation and cancellation have rules about the event types and transactions
+# they are connected to, which are not covered by the local rules
+REMOTE_STENCILS = {"EventbasedGateway", "StartCompensationEvent", "IntermediateCompensationEventCatching",
+                   "IntermediateCompensationEventThrowing", "EndCompensationEvent", "IntermediateCancelEvent",
+                   "EndCancelEvent"}
+
+def _is_start_event(stencil: str) -> bool:
+    return stencil.startswith("Start") and stencil.endswith("Event")
+
+def _is_end_event(stencil: str) -> bool:
+    return stencil.startswith("End") and stencil.endswith("Event")
+
+def _is_intermediate_event(stencil: str) -> bool:
+    return stencil.startswith("Intermediate") and "Event" in stencil
+
+def _is_known_stencil(stencil: str) -> bool:
+    return (stencil in ACTIVITY_STENCILS or stencil in GATEWAY_STENCILS or stencil in POOL_STENCILS
+            or stencil in OTHER_STENCILS or stencil in ("SequenceFlow", "MessageFlow") or _is_start_event(stencil)
+            or _is_end_event(stencil) or _is_intermediate_event(stencil))
+
+# the rule names check_model_syntax reports as errors and as warnings
+SYNTAX_ERROR_RULES = ["NO_SOURCE", "NO_TARGET", "SEQUENCE_FLOW_CROSSES_POOL", "MESSAGE_FLOW_IN_POOL",
+                      "START_EVENT_INCOMING", "END_EVENT_OUTGOING"]
+SYNTAX_WARNING_RULES = ["NO_START_EVENT", "NO_END_EVENT", "START_EVENT_NO_OUTGOING", "END_EVENT_NO_INCOMING",
+                        "INTERMEDIATE_EVENT_NO_INCOMING", "ATTACHED_EVENT_NO_OUTGOING", "NO_INCOMING", "NO_OUTGOING",
+                        "GATEWAY_NO_SPLIT_NO_JOIN"]
+SYNTAX_RULES = SYNTAX_ERROR_RULES + SYNTAX_WARNING_RULES
+
+_element_parser = BpmnModelParser(parse_outgoing=True, parse_parent=True)
+
+def check_model_syntax(model_json: Union[str, bytes, Dict], json_backend="auto") -> Optional[Dict[str, Dict]]:
+    """
+    Checks the local syntax rules of a BPMN 2.0 model, model_json is the Model JSON or its decoded dict.
+    Returns {'source': 'local', 'errors': {resourceId: [rule, ...]}, 'warnings': {...}} or None if the model has
+    elements the local rules cannot decide. The rules cover only part of the remote syntax checker, a model without
+    local findings may still have remote ones.
+    Errors:
+        - NO_SOURCE / NO_TARGET: sequence flow without source / target
+        - START_EVENT_INCOMING: start event with incoming sequence flow
+        - END_EVENT_OUTGOING: end event with outgoing sequence flow
+        - SEQUENCE_FLOW_CROSSES_POOL: sequence flow between elements of different pools
+        - MESSAGE_FLOW_IN_POOL: message flow between elements of the same pool
+    Warnings:
+        - NO_START_EVENT / NO_END_EVENT: model with flow nodes, but without start / end event (reported for the
+          model's resourceId)
+        - START_EVENT_NO_OUTGOING, END_EVENT_NO_INCOMING, INTERMEDIATE_EVENT_NO_INCOMING, ATTACHED_EVENT_NO_OUTGOING,
+          NO_INCOMING / NO_OUTGOING: flow node that is not connected by sequence flows (boundary events, event
+          subprocesses and link events are exempt from the checks that do not apply to them)
+        - GATEWAY_NO_SPLIT_NO_JOIN: gateway with at most one incoming and at most one outgoing sequence flow
+    """
+    if not isinstance(model_json, dict):
+        model_json = decoders.get_json_loads(json_backend)(model_json)
+    columns = _element_parser.get_model_elements(model_json)
+    stencils = dict(zip(columns["element_id"], columns["category"]))
+    parents = dict(zip(columns["element_id"], columns["parent"]))
+    outgoing = dict(zip(columns["element_id"], columns["outgoing"]))
+    if any(stencil is None or stencil in REMOTE_STENCILS or not _is_known_stencil(stencil)
+           for stencil in stencils.values()):
+        return None
+
+    errors, warnings = defaultdict(list), defaultdict(list)
+
+    def report(findings, rule, resource_id):
+        findings[resource_id].append(rule)
+
+    n_incoming, n_outgoing = defaultdict(int), defaultdict(int)
+    attached = set()
+    sources = {}
+    for element_id, targets in outgoing.items():
+        for target in targets:
+            target_stencil = stencils.get(target)
+            if target_stencil in ("SequenceFlow", "MessageFlow"):
+                sources[target] = element_id
+            elif target_stencil is not None and _is_intermediate_event(target_stencil):
+                # an activity's outgoing element that is an event (not a flow) is an attached boundary event
+                attached.add(target)
+
+    def pool_of(element_id):
+        while element_id is not None and stencils.get(element_id) not in POOL_STENCILS:
+            element_id = parents.get(element_id)
+        return element_id
+
+    for flow_id, stencil in stencils.items():
+        if stencil not in ("SequenceFlow", "MessageFlow"):
+            continue
+        source = sources.get(flow_id)
+        target = next((t for t in outgoing[flow_id] if t in stencils), None)
+        if stencil == "SequenceFlow":
+            if source is None or target is None:
+                if source is None:
+                    report(errors, "NO_SOURCE", flow_id)
+                if target is None:
+                    report(errors, "NO_TARGET", flow_id)
+                continue
+            n_outgoing[source] += 1
+            n_incoming[target] += 1
+            if pool_of(source) != pool_of(target):
+                report(errors, "SEQUENCE_FLOW_CROSSES_POOL", flow_id)
+        elif source is not None and target is not None and pool_of(source) is not None \
+                and pool_of(source) == pool_of(target):
+            report(errors, "MESSAGE_FLOW_IN_POOL", flow_id)
+
+    n_start_events, n_end_events, n_flow_nodes = 0, 0, 0
+    for element_id, stencil in stencils.items():
+        if _is_start_event(stencil):
+            n_start_events += 1
+            n_flow_nodes += 1
+            if n_incoming[element_id] > 0:
+                report(errors, "START_EVENT_INCOMING", element_id)
+            if n_outgoing[element_id] == 0:
+                report(warnings, "START_EVENT_NO_OUTGOING", element_id)
+        elif _is_end_event(stencil):
+            n_end_events += 1
+            n_flow_nodes += 1
+            if n_outgoing[element_id] > 0:
+                report(errors, "END_EVENT_OUTGOING", element_id)
+            if n_incoming[element_id] == 0:
+                report(warnings, "END_EVENT_NO_INCOMING", element_id)
+        elif stencil in ACTIVITY_STENCILS or stencil in GATEWAY_STENCILS or _is_intermediate_event(stencil):
+            n_flow_nodes += 1
+            if stencil in EVENT_SUBPROCESS_STENCILS:
+                continue
+            is_event = _is_intermediate_event(stencil)
+            if n_incoming[element_id] == 0 and element_id not in attached \
+                    and stencil != "IntermediateLinkEventCatching":
+                report(warnings, "INTERMEDIATE_EVENT_NO_INCOMING" if is_event else "NO_INCOMING", element_id)
+            if n_outgoing[element_id] == 0 and stencil != "IntermediateLinkEventThrowing":
+                report(warnings, "ATTACHED_EVENT_NO_OUTGOING" if element_id in attached else "NO_OUTGOING",
+                       element_id)
+            if stencil in GATEWAY_STENCILS and n_incoming[element_id] <= 1 and n_outgoing[element_id] <= 1:
+                report(warnings, "GATEWAY_NO_SPLIT_NO_JOIN", element_id)
+
+    if n_flow_nodes > 0 and n_start_events == 0:
+        report(warnings, "NO_START_EVENT", model_json.get("resourceId"))
+    if n_flow_nodes > 0 and n_end_events == 0:
+        report(warnings, "NO_END_EVENT", model_json.get("resourceId"))
+    return {"source": "local", "errors": dict(errors), "warnings": dict(warnings)}
+
+def _check_models_syntax(model_jsons: List, json_backend="auto") -> List[Optional[str]]:
+    results = []
+    for model_json in model_jsons:
+        result = check_model_syntax(model_json, json_backend)
+        results.append(None if result is None else json.dumps(result))
+    return results
+
+def check_syntax(df: pd.DataFrame, n_workers=1, chunksize=1000, json_backend="auto") -> pd.Series:
+    """
+    Checks the local syntax rules for every BPMN 2.0 model of df (as returned by parser.parse_model) and returns
+    the results of check_model_syntax as JSON strings (like SignavioConventionsChecker.syntax_checker in 'local'
+    mode) indexed by model_id. Models of
+    other namespaces and models the local rules cannot decide are None. With n_workers != 1 the models are checked
+    in a process pool (n_workers=None uses all cores) in chunks of chunksize models.
+    """
+    is_bpmn = (df["namespace"] == BPMN2_NAMESPACE).to_numpy()
+    model_jsons = df.loc[is_bpmn, "model_json"].tolist()
+    chunks = [model_jsons[i:i + chunksize] for i in range(0, len(model_jsons), chunksize)]
+    func = partial(_check_models_syntax, json_backend=json_backend)
+    if n_workers == 1:
+        results = [func(chunk) for chunk in tqdm(chunks)]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(tqdm(executor.map(func, chunks), total=len(chunks)))
+    # assigned by position, model ids may be duplicated
+    checked = pd.Series(None, index=df.index, dtype=object)
+    checked[is_bpmn] = [result for chunk in results for result in chunk]
+    _logger.info("Checked %d models locally, %d left to the remote syntax checker", checked.notna().sum(),
+                 is_bpmn.sum() - checked.notna().sum())
+    return checked
+
+def _check_syntax_csv(csv_path: Path, json_backend="auto") -> pd.Series:
+    df = parse_csv_raw(csv_path, usecols=["Model ID", "Namespace", "Model JSON"])
+    return check_syntax(df, json_backend=json_backend)
+
+def check_syntax_csvs(csv_paths=None, n_workers=1, json_backend="auto") -> pd.Series:
+    """
+    Same as check_syntax for the models of the csvs, which are checked csv by csv (in parallel with n_workers,
+    see parser.map_csvs), so that the dataset is never held in memory.
+    """
+    if csv_paths is None:
+        csv_paths = get_csv_paths()
+    func = partial(_check_syntax_csv, json_backend=json_backend)
+    return pd.concat(map_csvs(func, csv_paths, n_workers))
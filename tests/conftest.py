@@ -0,0 +1,143 @@
+import sys
+import json
+import types
+import uuid
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+import pytest
+
+class MockSignavio:
+    """
+    Local HTTP server that answers like a Signavio system instance: a login sets the JSESSIONID and LBROUTEID
+    cookies and returns the token, all other requests need these credentials (401 otherwise). The counters show
+    how many logins, connections and requests the clients made.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.valid_tokens = set()
+        self.logins = 0
+        self.connections = 0
+        self.requests = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self.lock:
+            self.valid_tokens.clear()
+            self.logins = 0
+            self.connections = 0
+            self.requests = []
+
+    def expire_sessions(self):
+        with self.lock:
+            self.valid_tokens.clear()
+
+    def login(self):
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.logins += 1
+            self.valid_tokens.add(token)
+        return token
+
+    def _make_handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with mock.lock:
+                    mock.connections += 1
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, code, body=b"", content_type="application/json", headers=()):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in headers:
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _read_form(self):
+                length = int(self.headers.get("Content-Length", 0))
+                return parse_qs(self.rfile.read(length).decode("utf-8"))
+
+            def _authorized(self):
+                token = self.headers.get("x-signavio-id")
+                cookies = self.headers.get("Cookie", "")
+                with mock.lock:
+                    mock.requests.append((self.command, self.path))
+                    return token in mock.valid_tokens and f"JSESSIONID={token}" in cookies \
+                        and "LBROUTEID=" in cookies
+
+            def do_POST(self):
+                self._read_form()
+                if self.path == "/p/login":
+                    token = mock.login()
+                    return self._send(200, token.encode("utf-8"), "text/plain", [
+                        ("Set-Cookie", f"JSESSIONID={token}; Path=/"), ("Set-Cookie", "LBROUTEID=route1; Path=/")])
+                if not self._authorized():
+                    return self._send(401, {})
+                if self.path == "/p/directory":
+                    return self._send(200, {"href": "/directory/sapsam1"})
+                if self.path == "/p/model":
+                    return self._send(200, {"href": f"/model/{uuid.uuid4().hex[:8]}",
+                                            "rep": {"revision": "/revision/rev1"}})
+                if self.path in ("/p/syntaxchecker", "/p/mgeditorchecker"):
+                    return self._send(200, {"rep": [{"must": ["e1"], "should": ["w1", "w2"], "info": []}]})
+                return self._send(404, {})
+
+            def do_GET(self):
+                if not self._authorized():
+                    return self._send(401, {})
+                if self.path == "/p/directory":
+                    return self._send(200, [{"rel": "dir", "href": "/directory/root1",
+                                             "rep": {"name": "My documents"}}])
+                if self.path.startswith("/p/directory/"):
+                    return self._send(200, [{"rel": "dir", "href": "/directory/sapsam1", "rep": {"name": "SAP-SAM"}}])
+                if self.path.startswith("/p/revision/"):
+                    return self._send(200, b"\x89PNG" + self.path.encode("utf-8"), "image/png")
+                return self._send(404, {})
+
+            def do_DELETE(self):
+                return self._send(200 if self._authorized() else 401, {})
+
+        return Handler
+
+_mock_signavio = MockSignavio()
+
+# the Signavio modules read the system instance and the credentials from sapsam.conf (not part of the repo), the
+# tests point them to the mock server instead
+_conf = types.ModuleType("sapsam.conf")
+_conf.system_instance = _mock_signavio.url
+_conf.email = "user@example.com"
+_conf.pw = "secret"
+_conf.tenant_id = "tenant1"
+sys.modules["sapsam.conf"] = _conf
+
+@pytest.fixture(scope="session")
+def _mock_signavio_server():
+    _mock_signavio.start()
+    yield _mock_signavio
+    _mock_signavio.stop()
+
+@pytest.fixture
+def mock_signavio(_mock_signavio_server):
+    _mock_signavio_server.reset()
+    return _mock_signavio_server
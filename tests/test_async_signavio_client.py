@@ -0,0 +1,90 @@
+import asyncio
+
+import httpx
+
+from sapsam.AsyncSignavioClient import AsyncSignavioClient
+from sapsam.RateLimiter import RateLimiter
+
+class FakeSignavio:
+    """
+    httpx.MockTransport handler that logs in every client, answers the other requests after a short delay and
+    records the largest number of requests in flight. failures maps a path to the statuses of its first responses.
+    """
+
+    def __init__(self, failures=None):
+        self.failures = {path: list(statuses) for path, statuses in (failures or {}).items()}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = {}
+
+    async def __call__(self, request):
+        path = request.url.path
+        self.calls[path] = self.calls.get(path, 0) + 1
+        if path == "/p/login":
+            return httpx.Response(200, content=b"token1", headers=[("Set-Cookie", "JSESSIONID=token1; Path=/"),
+                                                                   ("Set-Cookie", "LBROUTEID=route1; Path=/")])
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            self.in_flight -= 1
+        if self.failures.get(path):
+            status = self.failures[path].pop(0)
+            return httpx.Response(status, headers={"Retry-After": "0"} if status == 429 else {})
+        if path == "/p/syntaxchecker":
+            return httpx.Response(200, json={"rep": [{"must": ["e1"], "should": [], "info": []}]})
+        return httpx.Response(200, json=[])
+
+def _run(coro):
+    return asyncio.run(coro)
+
+def test_concurrency_is_capped():
+    server = FakeSignavio()
+
+    async def main():
+        async with AsyncSignavioClient("http://signavio.test", max_concurrency=3,
+                                       transport=httpx.MockTransport(server)) as client:
+            return await asyncio.gather(*(client.request("GET", f"/p/directory/{i}") for i in range(20)))
+
+    responses = _run(main())
+    assert [response.status_code for response in responses] == [200] * 20
+    assert server.max_in_flight == 3
+    assert server.calls["/p/login"] == 1
+
+def test_rate_limited_and_server_errors_are_retried():
+    server = FakeSignavio({"/p/syntaxchecker": [429, 503, 500]})
+
+    async def main():
+        async with AsyncSignavioClient("http://signavio.test", backoff=0.0,
+                                       transport=httpx.MockTransport(server)) as client:
+            return await client.syntax_check("{}")
+
+    assert _run(main()) == {"errors": ["e1"], "warnings": []}
+    assert server.calls["/p/syntaxchecker"] == 4
+
+def test_retries_are_limited():
+    server = FakeSignavio({"/p/directory": [502] * 5})
+
+    async def main():
+        async with AsyncSignavioClient("http://signavio.test", max_retries=2, backoff=0.0,
+                                       transport=httpx.MockTransport(server)) as client:
+            return await client.request("GET", "/p/directory")
+
+    assert _run(main()).status_code == 502
+    assert server.calls["/p/directory"] == 3
+
+def test_rate_limiter_is_shared():
+    server = FakeSignavio()
+    # 20 requests per second after a burst of 5: 15 requests have to wait for 0.75 s in total
+    rate_limiter = RateLimiter(20, 1.0, burst=5)
+
+    async def main():
+        async with AsyncSignavioClient("http://signavio.test", max_concurrency=10, rate_limiter=rate_limiter,
+                                       transport=httpx.MockTransport(server)) as client:
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            await asyncio.gather(*(client.request("GET", "/p/directory") for _ in range(20)))
+            return loop.time() - start
+
+    assert _run(main()) >= 0.7
@@ -0,0 +1,54 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from sapsam.RepresentationGenerator import RepresentationGenerator
+from sapsam.SignavioAuthenticator import SignavioAuthenticator
+from sapsam.SignavioClient import SignavioClient, resolve_client
+from sapsam.SignavioConventionsChecker import bp_conventions_checker, syntax_checker
+
+def test_requests_share_one_login_and_connection(mock_signavio):
+    with SignavioClient(mock_signavio.url) as client:
+        for _ in range(10):
+            assert client.get("/p/directory").status_code == 200
+    assert mock_signavio.logins == 1
+    assert mock_signavio.connections == 1
+
+def test_expired_session_is_renewed(mock_signavio):
+    with SignavioClient(mock_signavio.url) as client:
+        assert client.get("/p/directory").status_code == 200
+        mock_signavio.expire_sessions()
+        assert client.get("/p/directory").status_code == 200
+    assert mock_signavio.logins == 2
+
+def test_threads_renew_an_expired_session_once(mock_signavio):
+    with SignavioClient(mock_signavio.url, pool_size=8) as client:
+        client.authenticate()
+        mock_signavio.expire_sessions()
+        with ThreadPoolExecutor(8) as executor:
+            statuses = list(executor.map(lambda _: client.get("/p/directory").status_code, range(32)))
+    assert statuses == [200] * 32
+    assert mock_signavio.logins == 2
+    assert mock_signavio.connections <= 8
+
+def test_representations_use_one_login(mock_signavio):
+    generator = RepresentationGenerator(SignavioClient(mock_signavio.url))
+    for i in range(5):
+        assert generator.generate_image(f"model {i}", "{}", "ns").startswith(b"\x89PNG")
+    assert mock_signavio.logins == 1
+    assert mock_signavio.connections == 1
+
+def test_checkers_accept_auth_data(mock_signavio):
+    # the checkers took the credentials of SignavioAuthenticator.authenticate before there was a client
+    auth_data = SignavioAuthenticator.authenticate()
+    syntax_errors = syntax_checker("{}", auth_data, use_cache=False)
+    violations_count = bp_conventions_checker("name", "model1", "guideline1", "{}", auth_data=auth_data,
+                                              use_cache=False)
+    assert json.loads(syntax_errors) == {"errors": ["e1"], "warnings": ["w1", "w2"]}
+    assert json.loads(violations_count) == {"errors": 1, "warnings": 2, "info": 0}
+    assert mock_signavio.logins == 1
+    assert resolve_client(auth_data) is resolve_client(dict(auth_data))
+
+def test_generator_accepts_auth_data(mock_signavio):
+    auth_data = SignavioAuthenticator.authenticate()
+    assert RepresentationGenerator(auth_data).generate_image("model", "{}", "ns").startswith(b"\x89PNG")
+    assert mock_signavio.logins == 1